@@ -0,0 +1,113 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import collections
+import configparser
+import io
+
+import freezegun
+import pytest
+from freezegun import freeze_time
+
+from wattpilot.actor import WattPilotActor
+from wattpilot.engine import Response
+from wattpilot.replay import Trace
+
+# The scheduler measures real elapsed time, like threading.Timer does. Freezing time looks into every
+# module, it would trigger the lazy imports of anyio (under httpx) while other threads run
+freezegun.configure(extend_ignore_list=["wattpilot.scheduler", "anyio"])
+
+
+class FakeHttp:
+    # Stands in for the HTTP engine, the response goes to the callback right away
+
+    def __init__(self):
+        self.requests = []
+        # An exception is delivered as the error, a callable is given the request
+        self.response = Response(200, {}, b"")
+
+    def respond(self, body, status=200, headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.response = Response(status, headers or {}, body)
+
+    def request(self, callback, url, method="GET", headers=None, data=None, timeout=None):
+        request = FakeRequest(url, method, headers or {}, data)
+        self.requests.append(request)
+        response = self.response(request) if callable(self.response) else self.response
+        if isinstance(response, Exception):
+            callback(None, response)
+        else:
+            callback(response, None)
+
+    def get_stats(self, host):
+        return {}
+
+
+FakeRequest = collections.namedtuple("FakeRequest", ["url", "method", "headers", "data"])
+
+
+@pytest.fixture
+def http(mocker):
+    http = FakeHttp()
+    mocker.patch.object(WattPilotActor, "http", http)
+    return http
+
+
+@pytest.fixture
+def frozen():
+    with freeze_time("2020-06-07 06:00:00") as frozen:
+        yield frozen
+
+
+@pytest.fixture
+def config():
+    # Two loads, the replay and sweep tests run the same house
+    ini = """
+        [main]
+        hysteresis_to_grid = 200
+        hysteresis_from_grid = 0
+        schedule_start = 2
+        schedule_stop = 6
+        cloudiness_level = 75
+
+        [temperature]
+        temperature_schedule = 50
+        temperature_solar = 60
+
+        [load_1]
+        power = 1000
+        pin = 1
+
+        [load_2]
+        power = 2000
+        pin = 2
+    """
+    configuration = configparser.ConfigParser()
+    configuration.read_string(ini)
+    return configuration
+
+
+@pytest.fixture
+def day():
+    # Cloudy night then 4kW of sun from 10h to 16h, a sample every 5 minutes
+    lines = ["timestamp,power,temperature,cloudiness"]
+    for minute in range(0, 24 * 60, 5):
+        power = -3700 if 10 * 60 <= minute < 16 * 60 else 300
+        lines.append(f"{minute * 60},{power},40,90")
+    lines.append(f"{24 * 3600},300,,")
+    return Trace.from_csv(io.StringIO("\n".join(lines)))
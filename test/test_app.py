@@ -0,0 +1,147 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import connexion
+import pytest
+
+from wattpilot.actor import WattPilotActor
+from wattpilot.app import WattPilotApp
+from wattpilot.status import Status
+from wattpilot.wattpilot import LoadSnapshot
+
+
+@pytest.fixture
+def client(mocker):
+    for actor in ("wattpilot", "fronius", "temperature", "openweathermap"):
+        mocker.patch.object(WattPilotApp, actor)
+    mocker.patch.object(WattPilotApp, "history", None)
+    app = connexion.FlaskApp(__name__, specification_dir="../openapi")
+    app.add_api("swagger.yaml")
+    return app.test_client()
+
+
+class FakeFuture:
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self, timeout=None):
+        return self.value
+
+
+class TestWattPilotApp:
+
+    def test_get_loads(self, client):
+        WattPilotApp.wattpilot.get_active_loads.return_value = FakeFuture((LoadSnapshot(2, 2000, 1591531200, 1500),))
+        response = client.get("/v1/loads")
+        assert response.status_code == 200
+        assert response.json() == [
+            {"pin": 2, "state": True, "power": 2000, "since": "2020-06-07T12:00:00+00:00", "energy": 1500},
+        ]
+
+    def test_get_weather(self, mocker, client):
+        status = mocker.patch("wattpilot.app.status", Status())
+        response = client.get("/v1/weather")
+        assert response.json() == {"timestamp": None, "cloudiness": None, "will_run": None}
+        # Mean over the forecast window, what the decision was based on
+        status.update(cloudiness=90, forecast_timestamp=1591531200, decision_cloudiness=62.5, will_run=False)
+        response = client.get("/v1/weather")
+        assert response.status_code == 200
+        assert response.json() == {"timestamp": "2020-06-07T12:00:00+00:00", "cloudiness": 62, "will_run": False}
+        # A read, the control loop is not involved
+        WattPilotApp.wattpilot.get_scheduled_by_weather.assert_not_called()
+
+    def test_get_health(self, mocker, client):
+        WattPilotApp.fronius.get_reading.return_value = FakeFuture((-1200.5, 1591531200, True))
+        health = {"fronius": {"state": "open", "failures": 3, "retry_in": 12.5}}
+        mocker.patch.object(WattPilotActor, "http").get_health.return_value = health
+        response = client.get("/v1/health")
+        assert response.status_code == 200
+        assert response.json() == {
+            "upstreams": [{"host": "fronius", "state": "open", "failures": 3, "retry_in": 12.5}],
+            "power": {"power": -1200.5, "timestamp": "2020-06-07T12:00:00+00:00", "stale": True},
+        }
+
+    def test_get_temperature(self, client):
+        WattPilotApp.temperature.get_temperature.return_value = FakeFuture(51.23)
+        WattPilotApp.temperature.get_temperatures.return_value = FakeFuture({"top": 60.04, "bottom": None})
+        response = client.get("/v1/temperature")
+        assert response.status_code == 200
+        assert response.json() == {"temperature": 51.2, "sensors": {"top": 60.0, "bottom": None}}
+
+    def test_get_power_history(self, client):
+        WattPilotApp.fronius.get_history.return_value = FakeFuture([(1591531200, -200, 100, -50)])
+        response = client.get("/v1/history/power", params={
+            "start": "2020-06-07T00:00:00+00:00",
+            "end": "2020-06-08T00:00:00+00:00",
+            "points": 10,
+        })
+        assert response.status_code == 200
+        assert response.json() == [
+            {"timestamp": "2020-06-07T12:00:00+00:00", "minimum": -200, "maximum": 100, "mean": -50},
+        ]
+        WattPilotApp.fronius.get_history.assert_called_once_with(1591488000, 1591574400, 10)
+
+    def test_get_power_history_recorded(self, mocker, client):
+        history = mocker.patch.object(WattPilotApp, "history")
+        history.get_history.return_value = FakeFuture([(1591488000, -200, 100, -50)])
+        # Older than what the actor keeps in memory
+        WattPilotApp.fronius.get_history_start.return_value = FakeFuture(1591500000)
+        response = client.get("/v1/history/power", params={"start": "2020-06-07T00:00:00+00:00"})
+        assert response.status_code == 200
+        assert response.json()[0]["mean"] == -50
+        history.get_history.assert_called_once_with("power", 1591488000, mocker.ANY, 200)
+        WattPilotApp.fronius.get_history.assert_not_called()
+        # Within the memory of the actor
+        WattPilotApp.fronius.get_history.return_value = FakeFuture([])
+        WattPilotApp.fronius.get_history_start.return_value = FakeFuture(1591400000)
+        client.get("/v1/history/power", params={"start": "2020-06-07T00:00:00+00:00"})
+        WattPilotApp.fronius.get_history.assert_called_once()
+
+    def test_get_temperature_history_default_range(self, client):
+        WattPilotApp.temperature.get_history.return_value = FakeFuture([])
+        response = client.get("/v1/history/temperature")
+        assert response.status_code == 200
+        start, end, points = WattPilotApp.temperature.get_history.call_args.args
+        assert end - start == 86400
+        assert points == 200
+
+    def test_get_history_invalid_range(self, client):
+        response = client.get("/v1/history/power", params={
+            "start": "2020-06-08T00:00:00+00:00",
+            "end": "2020-06-07T00:00:00+00:00",
+        })
+        assert response.status_code == 400
+
+    def test_get_history_naive_time(self, client):
+        WattPilotApp.fronius.get_history.return_value = FakeFuture([])
+        response = client.get("/v1/history/power", params={"start": "2020-06-07T00:00:00"})
+        assert response.status_code == 200
+        start, end, _ = WattPilotApp.fronius.get_history.call_args.args
+        assert start == 1591488000
+        response = client.get("/v1/history/power", params={
+            "start": "2020-06-07T00:00:00",
+            "end": "2020-06-08T00:00:00",
+        })
+        assert response.status_code == 200
+        assert WattPilotApp.fronius.get_history.call_args.args == (1591488000, 1591574400, 200)
+
+    def test_get_state_history(self, client):
+        WattPilotApp.wattpilot.get_state_history.return_value = FakeFuture([(1591531200, "solar")])
+        response = client.get("/v1/history/state")
+        assert response.status_code == 200
+        assert response.json() == [{"timestamp": "2020-06-07T12:00:00+00:00", "state": "solar"}]
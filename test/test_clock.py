@@ -0,0 +1,92 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from datetime import UTC, datetime, timedelta
+
+import pykka
+import pytest
+
+from wattpilot.actor import WattPilotActor
+from wattpilot.clock import Clock, VirtualClock
+
+START = datetime(1981, 5, 30, tzinfo=UTC)
+
+
+@pytest.fixture
+def clock(mocker):
+    clock = VirtualClock(START)
+    mocker.patch.object(WattPilotActor, "clock", clock)
+    yield clock
+    pykka.ActorRegistry.stop_all()
+
+
+class Ticker(WattPilotActor):
+
+    def __init__(self, other=None):
+        super().__init__()
+        self.ticks = []
+        self.__other = other
+
+    def run(self, delay):
+        self.ticks.append(self.clock.now())
+        if self.__other:
+            self.__other.tick.defer(self.clock.now())
+        self.do_delay(delay, "run", args=[delay])
+
+    def tick(self, timestamp):
+        self.ticks.append(timestamp)
+
+    def get_ticks(self):
+        return self.ticks
+
+
+class TestClock:
+
+    def test_now(self):
+        assert Clock().now().tzinfo is UTC
+
+    def test_run_in_order(self, clock):
+        calls = []
+        clock.schedule(30, calls.append, args=[3])
+        clock.schedule(10, calls.append, args=[1])
+        clock.schedule(20, calls.append, args=[2])
+        clock.advance(15)
+        assert calls == [1]
+        assert clock.now() == START + timedelta(seconds=15)
+        clock.advance(15)
+        assert calls == [1, 2, 3]
+        assert clock.pending() == 0
+
+    def test_cancel(self, clock):
+        calls = []
+        timer = clock.schedule(10, calls.append, args=["cancelled"])
+        assert clock.pending() == 1
+        timer.cancel()
+        assert clock.pending() == 0
+        clock.advance(20)
+        assert calls == []
+
+    def test_actors_over_a_day(self, clock):
+        other = Ticker.start().proxy()
+        ticker = Ticker.start(other).proxy()
+        ticker.run.defer(60)
+        clock.advance(24 * 3600)
+        ticks = ticker.get_ticks().get()
+        assert len(ticks) == 24 * 60 + 1
+        assert ticks[-1] == START + timedelta(days=1)
+        # Messages sent to another actor are handled before time moves on
+        assert other.get_ticks().get() == ticks
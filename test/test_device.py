@@ -0,0 +1,67 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import sys
+
+import pytest
+
+from wattpilot.device import GpioDevice
+
+
+@pytest.fixture
+def GPIO(mocker):
+    # RPi.GPIO is only available on a Raspberry Pi
+    gpio = mocker.Mock(LOW=0, HIGH=1)
+    mocker.patch.dict(sys.modules, {"RPi": mocker.Mock(GPIO=gpio), "RPi.GPIO": gpio})
+    return gpio
+
+
+@pytest.fixture
+def device(GPIO):
+    device = GpioDevice()
+    for pin in (1, 2, 3):
+        device.setup(pin)
+    return device
+
+
+class TestGpioDevice:
+
+    def test_setup(self, GPIO, device):
+        GPIO.setup.assert_called_with(3, GPIO.OUT, initial=GPIO.HIGH)
+        assert not device.get_pin(1)
+
+    def test_set_pins(self, mocker, GPIO, device):
+        device.set_pins({1: True, 2: True})
+        GPIO.output.assert_called_once_with([1, 2], [GPIO.LOW, GPIO.LOW])
+        # Only what changed is written, in a single call
+        GPIO.output.reset_mock()
+        device.set_pins({1: False, 2: True, 3: True})
+        GPIO.output.assert_called_once_with([1, 3], [GPIO.HIGH, GPIO.LOW])
+        GPIO.output.reset_mock()
+        device.set_pin(3, True)
+        GPIO.output.assert_not_called()
+        assert [device.get_pin(pin) for pin in (1, 2, 3)] == [False, True, True]
+        GPIO.input.assert_not_called()
+
+    def test_verify(self, GPIO, device):
+        device.set_pins({1: True})
+        GPIO.output.reset_mock()
+        GPIO.input.side_effect = lambda pin: GPIO.HIGH
+        assert not device.verify()
+        GPIO.output.assert_called_once_with([1], [GPIO.LOW])
+        GPIO.input.side_effect = lambda pin: GPIO.LOW if pin == 1 else GPIO.HIGH
+        assert device.verify()
@@ -0,0 +1,243 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import http.server
+import queue
+import threading
+import time
+
+import httpx
+import pytest
+
+from wattpilot.engine import CircuitBreaker, CircuitOpenError, HttpEngine
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def __reply(self, status, body, headers=()):
+        self.server.clients.append(self.client_address)
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("ETag", '"abc"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(0.5)
+        if self.path == "/gzip":
+            self.__reply(200, b"not gzip", [("Content-Encoding", "gzip")])
+            return
+        status = 404 if self.path == "/missing" else 200
+        self.__reply(status, self.path.encode("ascii"))
+
+    def do_POST(self):
+        self.__reply(200, self.rfile.read(int(self.headers["Content-Length"])))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.clients = []
+    thread = threading.Thread(target=server.serve_forever, args=[0.01], daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def engine():
+    engine = HttpEngine(timeout=1)
+    yield engine
+    engine.stop()
+
+
+class Results:
+
+    def __init__(self):
+        self.__queue = queue.Queue()
+
+    def __call__(self, response, error):
+        self.__queue.put((response, error))
+
+    def get(self):
+        return self.__queue.get(timeout=5)
+
+
+def url(server, path):
+    host, port = server.server_address
+    return f"http://{host}:{port}{path}"
+
+
+class TestHttpEngine:
+
+    def test_get(self, engine, server):
+        results = Results()
+        engine.request(results, url(server, "/first"))
+        response, error = results.get()
+        assert error is None
+        assert response.status == 200
+        assert response.body == b"/first"
+        assert response.headers["etag"] == '"abc"'
+
+    def test_reuse_connection(self, engine, server):
+        results = Results()
+        engine.request(results, url(server, "/first"))
+        assert results.get()[0].body == b"/first"
+        engine.request(results, url(server, "/second"))
+        assert results.get()[0].body == b"/second"
+        assert server.clients[0] == server.clients[1]
+        host, port = server.server_address
+        stats = engine.get_stats(f"{host}:{port}")
+        assert stats["requests"] == 2
+        assert stats["maximum"] >= stats["average"] > 0
+
+    def test_post(self, engine, server):
+        results = Results()
+        engine.request(results, url(server, "/"), method="POST", data=b"data=1")
+        response, error = results.get()
+        assert error is None
+        assert response.body == b"data=1"
+
+    def test_status(self, engine, server):
+        results = Results()
+        engine.request(results, url(server, "/missing"))
+        response, error = results.get()
+        assert error is None
+        assert response.status == 404
+
+    def test_timeout(self, engine, server):
+        results = Results()
+        engine.request(results, url(server, "/slow"), timeout=0.1)
+        response, error = results.get()
+        assert response is None
+        assert isinstance(error, TimeoutError)
+
+    def test_connection_refused(self, engine):
+        results = Results()
+        engine.request(results, "http://127.0.0.1:1/")
+        response, error = results.get()
+        assert response is None
+        assert isinstance(error, ConnectionError)
+        assert engine.get_stats("127.0.0.1:1")["failures"] == 1
+
+    def test_undecodable_body(self, engine, server):
+        results = Results()
+        engine.request(results, url(server, "/gzip"))
+        response, error = results.get()
+        assert response is None
+        assert isinstance(error, httpx.DecodingError)
+
+    def test_undecodable_body_opens_circuit(self, server):
+        engine = HttpEngine(timeout=1, breaker={"threshold": 2, "backoff": 0.01})
+        try:
+            results = Results()
+            host, port = server.server_address
+            for state in ("closed", "open"):
+                engine.request(results, url(server, "/gzip"))
+                assert isinstance(results.get()[1], httpx.DecodingError)
+                assert engine.get_health()[f"{host}:{port}"]["state"] == state
+            # The half-open probe fails the same way, the circuit does not stay half-open
+            time.sleep(0.02)
+            engine.request(results, url(server, "/gzip"))
+            assert isinstance(results.get()[1], httpx.DecodingError)
+            assert engine.get_health()[f"{host}:{port}"]["state"] == "open"
+        finally:
+            engine.stop()
+
+    def test_callback_error(self, engine, server):
+        def callback(response, error):
+            raise RuntimeError("Actor stopped")
+
+        engine.request(callback, url(server, "/first")).result(timeout=5)
+        results = Results()
+        engine.request(results, url(server, "/second"))
+        assert results.get()[0].body == b"/second"
+
+    def test_circuit_open(self, server):
+        engine = HttpEngine(timeout=1, breaker={"threshold": 2})
+        try:
+            results = Results()
+            for _ in range(2):
+                engine.request(results, "http://127.0.0.1:1/")
+                assert type(results.get()[1]) is ConnectionError
+            assert engine.get_health()["127.0.0.1:1"]["state"] == "open"
+            engine.request(results, "http://127.0.0.1:1/")
+            assert isinstance(results.get()[1], CircuitOpenError)
+            # Other upstreams are not affected
+            engine.request(results, url(server, "/first"))
+            assert results.get()[0].body == b"/first"
+        finally:
+            engine.stop()
+
+
+class TestCircuitBreaker:
+
+    @pytest.fixture
+    def clock(self):
+        return [0]
+
+    @pytest.fixture
+    def breaker(self, clock):
+        return CircuitBreaker(threshold=2, backoff=10, maximum=30, clock=lambda: clock[0])
+
+    def test_open(self, breaker):
+        assert breaker.allow()
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.success()
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+        assert 5 <= breaker.get_retry_in() <= 10
+
+    def test_half_open(self, breaker, clock):
+        breaker.failure()
+        breaker.failure()
+        clock[0] += 10
+        assert breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        # A single request goes through
+        assert not breaker.allow()
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        # Twice as long
+        assert 10 <= breaker.get_retry_in() <= 20
+        clock[0] += 20
+        assert breaker.allow()
+        breaker.success()
+        assert breaker.as_dict() == {"state": "closed", "failures": 0, "retry_in": 0}
+
+    def test_maximum(self, breaker, clock):
+        for _ in range(5):
+            breaker.failure()
+            breaker.failure()
+            assert breaker.get_retry_in() <= 30
+            clock[0] += 30
+            assert breaker.allow()
+        assert breaker.get_retry_in() == 0
+
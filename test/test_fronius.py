@@ -16,12 +16,14 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import configparser
+import json
 import os
 
 import pykka
 import pytest
 
-from wattpilot.fronius import Fronius
+from wattpilot.engine import CircuitOpenError, Response
+from wattpilot.fronius import EnergyReading, Fronius
 
 
 @pytest.fixture
@@ -47,12 +49,18 @@ def config():
 
 
 @pytest.fixture
-def fronius(mocker, config):
+def fronius(mocker, config, http):
     fronius = Fronius.start(config).proxy()
     yield fronius
     pykka.ActorRegistry.stop_all()
 
 
+@pytest.fixture
+def start_fronius(config, http):
+    yield lambda: Fronius.start(config).proxy()
+    pykka.ActorRegistry.stop_all()
+
+
 class TestFronius:
 
     @staticmethod
@@ -60,14 +68,113 @@ class TestFronius:
         with open(os.path.join("test/assets", f"{filename}.json")) as f:
             return f.read()
 
-    def test_run(self, mocker, fronius):
-        mocker.patch.object(Fronius, "download").return_value = self.__read_json_asset("meter01")
+    def test_run(self, mocker, fronius, http):
+        http.respond(self.__read_json_asset("meter01"))
         fronius.run_internal(9999).get()
         assert fronius.get_power().get() == 0
-        mocker.patch.object(Fronius, "download").return_value = self.__read_json_asset("meter02")
+        http.respond(self.__read_json_asset("meter02"))
         fronius.run_internal(9999).get()
         assert 400 < fronius.get_power().get() < 500
-        mocker.patch.object(Fronius, "download").return_value = self.__read_json_asset("meter02")
+        http.respond(self.__read_json_asset("meter02"))
         fronius.run_internal(9999).get()
         # We use an average
         assert fronius.get_power().get() > 0
+
+    def test_get_history(self, mocker, fronius, http):
+        http.respond(self.__read_json_asset("meter01"))
+        fronius.run_internal(9999).get()
+        http.respond(self.__read_json_asset("meter02"))
+        fronius.run_internal(9999).get()
+        history = fronius.get_history(0, 2**32, 10).get()
+        assert len(history) == 1
+        _, minimum, maximum, mean = history[0]
+        assert 400 < minimum == maximum == mean < 500
+
+    @pytest.mark.parametrize("asset", ["meter01", "meter02"])
+    def test_parse_reading(self, asset):
+        raw = self.__read_json_asset(asset)
+        reading = EnergyReading.parse(raw.encode("ascii"))
+        expected = EnergyReading.from_document(json.loads(raw))
+        assert reading.timestamp == expected.timestamp
+        assert reading.consumed == expected.consumed
+        assert reading.produced == expected.produced
+        assert not hasattr(reading, "__dict__")
+
+    def test_parse_reading_several_meters(self):
+        document = json.loads(self.__read_json_asset("meter01"))
+        meter = document["Body"]["Data"]["0"]
+        document["Body"]["Data"]["1"] = dict(meter, TimeStamp=1, EnergyReal_WAC_Sum_Consumed=1)
+        reading = EnergyReading.parse(json.dumps(document).encode("ascii"))
+        assert reading.timestamp == meter["TimeStamp"]
+        assert reading.consumed == meter["EnergyReal_WAC_Sum_Consumed"]
+
+    @pytest.mark.parametrize(("source", "asset", "power"), [
+        ("meter", "meter01", 478.08),
+        ("powerflow", "powerflow01", -3912.5),
+    ])
+    def test_run_instantaneous(self, mocker, config, start_fronius, http, source, asset, power):
+        config.set("main", "fronius_power_source", source)
+        fronius = start_fronius()
+        callback = mocker.Mock()
+        fronius.register_callback(callback).get()
+        http.respond(self.__read_json_asset(asset))
+        # A value is available after the first poll already
+        fronius.run_internal(9999).get()
+        assert fronius.get_power().get() == pytest.approx(power)
+        callback.defer.assert_called_once_with(pytest.approx(power), mocker.ANY)
+
+    def test_run_powerflow_no_grid_value(self, mocker, config, start_fronius, http):
+        config.set("main", "fronius_power_source", "powerflow")
+        fronius = start_fronius()
+        document = json.loads(self.__read_json_asset("powerflow01"))
+        document["Body"]["Data"]["Site"]["P_Grid"] = None
+        http.respond(json.dumps(document))
+        fronius.run_internal(9999).get()
+        assert fronius.get_power().get() == 0
+
+    def test_invalid_power_source(self, config, start_fronius):
+        config.set("main", "fronius_power_source", "unknown")
+        with pytest.raises(ValueError, match="unknown"):
+            start_fronius()
+
+    def test_run_invalid_document(self, mocker, fronius, http):
+        http.respond(b"<html></html>")
+        fronius.run_internal(9999).get()
+        assert fronius.get_power().get() == 0
+
+    def test_download(self, fronius, http):
+        fronius.run_internal(9999).get()
+        assert http.requests[0].url == "http://fronius/solar_api/v1/GetMeterRealtimeData.cgi?Scope=System"
+
+    @pytest.mark.parametrize("response", [TimeoutError(), ConnectionRefusedError(), Response(500, {}, b"")])
+    def test_run_error(self, fronius, http, response):
+        http.response = response
+        fronius.run_internal(9999).get()
+        assert fronius.get_power().get() == 0
+
+    def test_reading(self, config, start_fronius, http, frozen):
+        config.set("main", "fronius_power_source", "powerflow")
+        fronius = start_fronius()
+        assert fronius.get_reading().get() == (None, None, True)
+        http.respond(self.__read_json_asset("powerflow01"))
+        fronius.run_internal(9999).get()
+        assert fronius.get_reading().get() == (-3912.5, frozen.time_to_freeze.timestamp(), False)
+        frozen.tick(181)
+        assert fronius.get_reading().get()[2]
+
+    def test_failure_pushes_last_reading(self, mocker, config, start_fronius, http, frozen):
+        config.set("main", "fronius_power_source", "powerflow")
+        fronius = start_fronius()
+        callback = mocker.Mock()
+        fronius.register_callback(callback).get()
+        http.respond(self.__read_json_asset("powerflow01"))
+        fronius.run_internal(9999).get()
+        frozen.tick(60)
+        http.response = CircuitOpenError("open")
+        fronius.run_internal(9999).get()
+        fronius.get_power().get()
+        # Same reading, with its original timestamp
+        timestamp = frozen.time_to_freeze.timestamp() - 60
+        assert callback.defer.call_args_list == [mocker.call(-3912.5, timestamp),
+                                                 mocker.call(-3912.5, timestamp, repeated=True)]
+
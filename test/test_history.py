@@ -0,0 +1,107 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import configparser
+import time
+
+import pykka
+import pytest
+
+from wattpilot.history import History, TimeSeriesStore
+from wattpilot.status import Status
+
+
+@pytest.fixture
+def config(tmp_path):
+    configuration = configparser.ConfigParser()
+    configuration.read_dict({"history": {"path": str(tmp_path / "history.db")}})
+    return configuration
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = TimeSeriesStore(str(tmp_path / "store.db"))
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def status(mocker):
+    status = Status()
+    mocker.patch("wattpilot.history.status", status)
+    return status
+
+
+@pytest.fixture
+def history(config, status):
+    history = History.start(config).proxy()
+    yield history
+    pykka.ActorRegistry.stop_all()
+
+
+class TestTimeSeriesStore:
+
+    def test_append(self, store):
+        store.append([("power", 3600, -100), ("power", 3630, -300), ("power", 7200, 50),
+                      ("state", 3610, "solar")])
+        assert store.get_samples("power", 3600, 7200) == [(3600, -100), (3630, -300)]
+        assert store.get_samples("state", 0, 10000) == [(3610, "solar")]
+        assert store.get_rollups("power", 0, 10000) == [(3600, -300, -100, -200, 2), (7200, 50, 50, 50, 1)]
+        assert store.get_rollups("state", 0, 10000) == []
+
+    def test_append_rollup_batches(self, store):
+        store.append([("temperature", 3600, 50)])
+        store.append([("temperature", 3700, 60)])
+        assert store.get_rollups("temperature", 0, 10000) == [(3600, 50, 60, 55, 2)]
+
+    def test_prune(self, store):
+        store.append([("power", 3600, -100), ("power", 7200, -300)])
+        store.prune(samples_before=7200, rollups_before=0)
+        assert store.get_samples("power", 0, 10000) == [(7200, -300)]
+        assert len(store.get_rollups("power", 0, 10000)) == 2
+
+
+class TestHistory:
+
+    def test_record(self, history, status):
+        status.update(power=-100, power_timestamp=1000)
+        status.update(temperature=55.5, temperature_timestamp=1010)
+        # Same power, new sample
+        status.update(power=-100, power_timestamp=1030)
+        status.update(state="idle", state_timestamp=1040)
+        status.update(loads=(1,))
+        assert history.get_samples("power", 0, 2000).get() == [(1000, -100), (1030, -100)]
+        assert history.get_samples("temperature", 0, 2000).get() == [(1010, 55.5)]
+        assert history.get_samples("state", 0, 2000).get() == [(1040, "idle")]
+
+    def test_get_history(self, history, status):
+        # Older than the retention, served from the hourly rollups
+        for timestamp, power in [(3600, -100), (3630, -300), (7200, 50)]:
+            status.update(power=power, power_timestamp=timestamp)
+        assert history.get_history("power", 0, 10800, 3).get() == [(3600, -300, -100, -200), (7200, 50, 50, 50)]
+        # Recent, from the raw samples
+        now = time.time()
+        status.update(power=-100, power_timestamp=now - 10)
+        status.update(power=-300, power_timestamp=now - 5)
+        assert history.get_history("power", now - 3600, now, 1).get() == [(now - 3600, -300, -100, -200)]
+
+    def test_flush_on_stop(self, config, history, status):
+        status.update(power=-100, power_timestamp=1000)
+        history.actor_ref.stop()
+        store = TimeSeriesStore(config.get("history", "path"))
+        assert store.get_samples("power", 0, 2000) == [(1000, -100)]
+        store.close()
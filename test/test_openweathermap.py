@@ -16,13 +16,15 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import configparser
+import json
 import os
 
 import pykka
 import pytest
 from freezegun import freeze_time
 
-from wattpilot.openweathermap import OpenWeatherMap
+from wattpilot.engine import Response
+from wattpilot.openweathermap import Forecast, OpenWeatherMap
 
 
 @pytest.fixture
@@ -39,28 +41,28 @@ def config():
 
 
 @pytest.fixture
-def openweathermap(mocker, config):
+def openweathermap(mocker, config, http):
     with freeze_time("2020-06-07 06:00:00"):
         openweathermap = OpenWeatherMap.start(config).proxy()
         yield openweathermap
         pykka.ActorRegistry.stop_all()
 
 
-class TestOpenWeatherMap:
+def read_json_asset(filename):
+    with open(os.path.join("test/assets", f"{filename}.json")) as f:
+        return f.read()
+
 
-    @staticmethod
-    def __read_json_asset(filename):
-        with open(os.path.join("test/assets", f"{filename}.json")) as f:
-            return f.read()
+class TestOpenWeatherMap:
 
     @pytest.mark.parametrize(("asset", "cloud"), [
         ("weather01", 27),
         # ("weather02", 75),
         # ("weather03", 75),
     ])
-    def test_update_forecast(self, asset, cloud, mocker, openweathermap):
-        mocker.patch.object(OpenWeatherMap, "download").return_value = self.__read_json_asset(asset)
-        openweathermap.run.defer()
+    def test_update_forecast(self, asset, cloud, http, openweathermap):
+        http.respond(read_json_asset(asset))
+        openweathermap.run().get()
         assert openweathermap.get_cloudiness().get() == cloud
 
     @pytest.mark.parametrize(("asset", "forecast"), [
@@ -68,7 +70,118 @@ class TestOpenWeatherMap:
         # ("weather02", (1591527600, 75)),
         # ("weather03", (1591527600, 75)),
     ])
-    def test_get_forecast(self, asset, forecast, mocker, openweathermap):
-        mocker.patch.object(OpenWeatherMap, "download").return_value = self.__read_json_asset(asset)
-        openweathermap.run.defer()
+    def test_get_forecast(self, asset, forecast, http, openweathermap):
+        http.respond(read_json_asset(asset))
+        openweathermap.run().get()
         assert openweathermap.get_forecast().get() == forecast
+
+    def test_conditional_request(self, http, openweathermap):
+        http.respond(read_json_asset("weather01"), headers={"etag": '"abc"', "last-modified": "yesterday"})
+        openweathermap.run_internal(3600).get()
+        assert http.requests[0].headers == {}
+        assert http.requests[0].url == ("https://api.openweathermap.org/data/2.5/forecast"
+                                        "?lat=46.687901&lon=6.898991&appid=1234567890")
+        openweathermap.run_internal(3600).get()
+        assert http.requests[1].headers == {"If-None-Match": '"abc"', "If-Modified-Since": "yesterday"}
+
+    def test_not_modified(self, mocker, http, openweathermap):
+        http.respond(read_json_asset("weather01"))
+        openweathermap.run_internal(3600).get()
+        loads = mocker.spy(json, "loads")
+        http.respond(b"", status=304)
+        openweathermap.run_internal(3600).get()
+        assert openweathermap.get_forecast().get() == (1741651200, 27)
+        loads.assert_not_called()
+
+    def test_unchanged(self, mocker, http, openweathermap):
+        http.respond(read_json_asset("weather01"))
+        openweathermap.run_internal(3600).get()
+        loads = mocker.spy(json, "loads")
+        openweathermap.run_internal(3600).get()
+        assert openweathermap.get_forecast().get() == (1741651200, 27)
+        loads.assert_not_called()
+
+    @pytest.mark.parametrize("response", [TimeoutError(), ConnectionRefusedError(), Response(500, {}, b""),
+                                          Response(200, {}, b"<html></html>")])
+    def test_error(self, http, openweathermap, response):
+        http.respond(read_json_asset("weather01"))
+        openweathermap.run_internal(3600).get()
+        http.response = response
+        openweathermap.run_internal(3600).get()
+        # The last forecast is kept
+        assert openweathermap.get_forecast().get() == (1741651200, 27)
+
+    def test_cache(self, config, tmp_path, http):
+        config.set("openweathermap", "cache", str(tmp_path / "forecast.json"))
+        http.respond(read_json_asset("weather01"), headers={"etag": '"abc"'})
+        with freeze_time("2020-06-07 06:00:00"):
+            openweathermap = OpenWeatherMap.start(config).proxy()
+            openweathermap.run_internal(3600).get()
+            openweathermap.actor_ref.stop()
+            # Restarted within the hour, the cached forecast is used
+            openweathermap = OpenWeatherMap.start(config).proxy()
+            assert openweathermap.get_forecast().get() == (1741651200, 27)
+            openweathermap.run().get()
+            assert len(http.requests) == 1
+            pykka.ActorRegistry.stop_all()
+        with freeze_time("2020-06-07 08:00:00"):
+            openweathermap = OpenWeatherMap.start(config).proxy()
+            openweathermap.run().get()
+            pykka.ActorRegistry.stop_all()
+        assert http.requests[1].headers == {"If-None-Match": '"abc"'}
+
+    def test_invalid_cache(self, config, tmp_path, http):
+        path = tmp_path / "forecast.json"
+        path.write_text("{")
+        config.set("openweathermap", "cache", str(path))
+        http.respond(read_json_asset("weather01"))
+        with freeze_time("2020-06-07 06:00:00"):
+            openweathermap = OpenWeatherMap.start(config).proxy()
+            openweathermap.run().get()
+            assert len(http.requests) == 1
+            assert openweathermap.get_forecast().get() == (1741651200, 27)
+            pykka.ActorRegistry.stop_all()
+
+
+class TestForecast:
+
+    @pytest.fixture
+    def forecast(self):
+        return Forecast([0, 3600, 7200], [0, 50, 100], [10, 12, 14])
+
+    def test_next(self, forecast):
+        assert forecast.next(-1) == (0, 0)
+        assert forecast.next(0) == (3600, 50)
+        assert forecast.next(7200) == (0, 100)
+
+    def test_cloudiness(self, forecast):
+        assert forecast.cloudiness(0, 3600) == 0
+        assert forecast.cloudiness(1800, 5400) == 25
+        assert forecast.cloudiness(0, 3 * 3600) == 50
+        # The last slot holds for the forecast period
+        assert forecast.cloudiness(7200, 8 * 3600) == 100
+        # Only the covered part of the window counts
+        assert forecast.cloudiness(-3600, 3600) == 0
+        assert forecast.cloudiness(-3600, 0) is None
+        assert Forecast().cloudiness(0, 3600) is None
+
+    def test_irradiance(self, forecast):
+        assert forecast.irradiance(0, 3600) == 1
+        assert forecast.irradiance(7200, 8 * 3600) == pytest.approx(0.25)
+        assert 0.25 < forecast.irradiance(3600, 7200) < 1
+
+    def test_from_document(self):
+        with open("test/assets/weather01.json") as f:
+            forecast = Forecast.from_document(json.load(f))
+        assert len(forecast) == 40
+        assert forecast.next(0) == (1741651200, 27)
+        assert forecast.temperatures[0] == pytest.approx(6.62)
+        assert Forecast(**forecast.as_dict()).cloudiness(0, 2e9) == forecast.cloudiness(0, 2e9)
+
+    def test_get_cloudiness_window(self, http, openweathermap):
+        http.respond(read_json_asset("weather01"))
+        openweathermap.run().get()
+        assert openweathermap.get_cloudiness(1741651200, 1741651200 + 6 * 3600).get() == 47
+        # Not covered by the forecast, the next slot
+        assert openweathermap.get_cloudiness(0, 3600).get() == 27
+        assert openweathermap.get_irradiance(0, 3600).get() is None
@@ -16,23 +16,25 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import configparser
+import urllib.parse
 
 import pykka
 import pytest
-from freezegun import freeze_time
 
 from test.test_wattpilot import FakeFuture
-from wattpilot.pvoutput import PVOutput
+from wattpilot.pvoutput import PVOutput, Spool
 from wattpilot.temperature import Temperature
 
 
 @pytest.fixture
-def config():
-    ini = """
+def config(tmp_path):
+    ini = f"""
         [pvoutput]
         key=1234
         sid=5678
         field=v12
+        upload_interval = 900
+        spool = {tmp_path / "pvoutput.spool"}
     """
     configuration = configparser.ConfigParser()
     configuration.read_string(ini)
@@ -47,21 +49,106 @@ def temperature(mocker):
 
 
 @pytest.fixture
-def pvoutput(mocker, config, temperature):
-    with freeze_time("2020-06-07 06:00:00"):
+def pvoutput(mocker, config, temperature, frozen, http):
+    actor = PVOutput.start(config, temperature).proxy()
+    yield actor
+    pykka.ActorRegistry.stop_all()
+
+
+def sent(http):
+    # Statuses of every upload
+    return [urllib.parse.parse_qs(request.data.decode("ascii"))["data"][0].split(";") for request in http.requests]
+
+
+class TestPVOutput:
+
+    def test_send_temperature(self, pvoutput, http):
+        pvoutput.run().get()
+        assert len(http.requests) == 1
+        request = http.requests[0]
+        assert request.url == "https://pvoutput.org/service/r2/addbatchstatus.jsp"
+        assert request.method == "POST"
+        assert request.headers == {"X-Pvoutput-Apikey": "1234", "X-Pvoutput-SystemId": "5678",
+                                   "Content-Type": "application/x-www-form-urlencoded"}
+        assert sent(http) == [["20200607,06:00,,,,,,,,,,,,50"]]
+
+    def test_upload_interval(self, pvoutput, http, frozen):
+        for _ in range(4):
+            pvoutput.run_internal(300).get()
+            frozen.tick(300)
+        assert sent(http) == [
+            ["20200607,06:00,,,,,,,,,,,,50"],
+            ["20200607,06:05,,,,,,,,,,,,50", "20200607,06:10,,,,,,,,,,,,50", "20200607,06:15,,,,,,,,,,,,50"],
+        ]
+        assert pvoutput.get_spooled().get() == 0
+
+    def test_backoff(self, pvoutput, http, frozen):
+        http.response = ConnectionRefusedError()
+        pvoutput.run_internal(300).get()
+        assert len(http.requests) == 1
+        frozen.tick(300)
+        pvoutput.run_internal(300).get()
+        # Retried after 600s
+        assert len(http.requests) == 1
+        frozen.tick(300)
+        http.respond(b"")
+        pvoutput.run_internal(300).get()
+        assert len(http.requests) == 2
+        assert len(sent(http)[-1]) == 3
+        assert pvoutput.get_spooled().get() == 0
+
+    def test_timeout(self, pvoutput, http):
+        http.response = TimeoutError()
+        pvoutput.run_internal(300).get()
+        assert pvoutput.get_spooled().get() == 1
+
+    def test_batches(self, config, temperature, http, frozen):
+        spool = Spool(config.get("pvoutput", "spool"), maxlen=100)
+        for i in range(40):
+            spool.append(frozen.time_to_freeze.timestamp() - 3600 + i * 60, 40)
         actor = PVOutput.start(config, temperature).proxy()
-        yield actor
+        actor.run().get()
         pykka.ActorRegistry.stop_all()
+        assert [len(statuses) for statuses in sent(http)] == [30, 11]
 
+    def test_rejected(self, pvoutput, http):
+        http.respond(b"Bad request", status=400)
+        pvoutput.run_internal(300).get()
+        assert pvoutput.get_spooled().get() == 0
 
-class TestPVOutput:
+    def test_spool_survives_restart(self, config, temperature, http, frozen):
+        http.response = ConnectionRefusedError()
+        actor = PVOutput.start(config, temperature).proxy()
+        actor.run_internal(300).get()
+        actor.stop()
+        http.respond(b"")
+        actor = PVOutput.start(config, temperature).proxy()
+        assert actor.get_spooled().get() == 1
+        frozen.tick(300)
+        actor.run_internal(300).get()
+        pykka.ActorRegistry.stop_all()
+        assert sent(http)[-1] == ["20200607,06:00,,,,,,,,,,,,50", "20200607,06:05,,,,,,,,,,,,50"]
 
-    def test_send_temperature(self, mocker, pvoutput):
-        def call(url):
-            assert url == "https://pvoutput.org/service/r2/addstatus.jsp?key=1234&sid=5678&d=20200607&t=06:00&v12=50"
-            return mocker.MagicMock()
 
-        mock = mocker.patch("urllib.request.urlopen")
-        mock.side_effect = call
-        pvoutput.run().get()
-        mock.assert_called_once()
+class TestSpool:
+
+    def test_spool(self, tmp_path):
+        path = tmp_path / "spool"
+        spool = Spool(path, maxlen=3)
+        for i in range(4):
+            spool.append(i, i * 10)
+        assert spool.peek(2) == [(1, 10), (2, 20)]
+        spool.remove(1)
+        assert Spool(path, maxlen=3).peek(5) == [(2, 20), (3, 30)]
+
+    def test_memory(self):
+        spool = Spool(None, maxlen=3)
+        spool.append(1, 10)
+        assert len(spool) == 1
+        spool.remove(5)
+        assert len(spool) == 0
+
+    def test_invalid(self, tmp_path):
+        path = tmp_path / "spool"
+        path.write_text("1 10\ninvalid\n")
+        assert Spool(path, maxlen=3).peek(5) == [(1, 10)]
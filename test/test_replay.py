@@ -0,0 +1,68 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import io
+
+import pytest
+
+from wattpilot.replay import Trace, account, format_report, replay
+
+
+class TestReplay:
+
+    def test_trace(self):
+        trace = Trace.from_csv(io.StringIO(
+            "timestamp,power,temperature,cloudiness\n"
+            "1970-01-01T00:01:00,200,,\n"
+            "0,100,40,80\n"
+            "120,300,,\n"))
+        assert list(trace.timestamps) == [0, 60, 120]
+        # Missing values are carried over in time order, not file order
+        assert list(trace.temperature) == [40, 40, 40]
+        assert list(trace.cloudiness) == [80, 80, 80]
+        assert trace.power[trace.index(90)] == 200
+        assert trace.power[trace.index(-10)] == 100
+
+    def test_empty_trace(self):
+        with pytest.raises(ValueError, match="Empty trace"):
+            Trace.from_csv(io.StringIO("timestamp,power,temperature,cloudiness\n"))
+
+    def test_account(self):
+        trace = Trace([0, 3600], [-2000, 500], [40, 40], [0, 0])
+        switches = [(1800, 1, True), (5400, 1, False)]
+        transitions = [(0, "idle"), (1800, "solar"), (5400, "idle")]
+        report = account(trace, switches, transitions, {1: 1000}, 7200)
+        assert report["switches"] == 2
+        assert report["diverted"] == pytest.approx(1000)
+        assert report["imported"] == pytest.approx(750 + 250)
+        assert report["exported"] == pytest.approx(1000 + 500)
+        assert report["time_in_state"] == {"idle": 3600, "solar": 3600}
+
+    def test_replay_day(self, config, day):
+        report = replay(config, day)
+        assert report["switches"] == 8
+        assert report["time_in_state"] == pytest.approx({"idle": 14 * 3600, "schedule": 4 * 3600, "solar": 6 * 3600},
+                                                        abs=120)
+        # 12kWh on schedule, most of the 18kWh of the loads on the sun
+        assert report["diverted"] == pytest.approx(12000 + 18000, abs=100)
+        assert report["imported"] == pytest.approx(18 * 300 + 12000, abs=100)
+        assert "Switches: 8\n" in format_report(report)
+
+    def test_replay_verify_outputs(self, config, day):
+        # As in the shipped configuration
+        config.set("main", "gpio_verify_interval", "300")
+        assert replay(config, day)["switches"] == 8
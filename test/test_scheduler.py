@@ -0,0 +1,76 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import threading
+
+import pytest
+
+from wattpilot.scheduler import Scheduler
+
+
+@pytest.fixture
+def scheduler():
+    return Scheduler()
+
+
+class TestScheduler:
+
+    def test_schedule_in_order(self, scheduler):
+        done = threading.Event()
+        calls = []
+
+        def call(value):
+            calls.append(value)
+            if len(calls) == 3:
+                done.set()
+
+        scheduler.schedule(0.03, call, args=[3])
+        scheduler.schedule(0.01, call, args=[1])
+        scheduler.schedule(0.02, call, args=[2])
+        assert done.wait(1)
+        assert calls == [1, 2, 3]
+        assert scheduler.pending() == 0
+
+    def test_cancel(self, scheduler):
+        done = threading.Event()
+        calls = []
+        timer = scheduler.schedule(0.01, calls.append, args=["cancelled"])
+        scheduler.schedule(0.02, done.set)
+        assert scheduler.pending() == 2
+        timer.cancel()
+        assert scheduler.pending() == 1
+        assert done.wait(1)
+        assert calls == []
+        assert scheduler.pending() == 0
+
+    def test_cancel_many(self, scheduler):
+        timers = [scheduler.schedule(60, print) for _ in range(1000)]
+        for timer in timers[:-1]:
+            timer.cancel()
+        # Cancelling twice has no effect
+        timers[0].cancel()
+        assert scheduler.pending() == 1
+
+    def test_failing_callback(self, scheduler):
+        done = threading.Event()
+
+        def fail():
+            raise ValueError
+
+        scheduler.schedule(0, fail)
+        scheduler.schedule(0.01, done.set)
+        assert done.wait(1)
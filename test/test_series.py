@@ -0,0 +1,73 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+
+from wattpilot.series import RingBuffer, downsample, merge
+
+
+class TestRingBuffer:
+
+    def test_range(self):
+        buffer = RingBuffer(10)
+        for timestamp in range(5):
+            buffer.append(timestamp, timestamp * 10)
+        assert len(buffer) == 5
+        assert buffer.range(1, 3) == ([1, 2], [10, 20])
+        assert buffer.range(-10, 100) == ([0, 1, 2, 3, 4], [0, 10, 20, 30, 40])
+        assert buffer.range(10, 20) == ([], [])
+
+    def test_first(self):
+        buffer = RingBuffer(3)
+        assert buffer.first is None
+        for timestamp in range(5):
+            buffer.append(timestamp, timestamp * 10)
+        assert buffer.first == 2
+
+    def test_overwrite_oldest(self):
+        buffer = RingBuffer(3)
+        for timestamp in range(5):
+            buffer.append(timestamp, timestamp * 10)
+        assert len(buffer) == 3
+        assert buffer.range(0, 10) == ([2, 3, 4], [20, 30, 40])
+        assert buffer.range(3, 4) == ([3], [30])
+
+
+class TestDownsample:
+
+    def test_buckets(self):
+        timestamps = list(range(100))
+        values = [timestamp % 10 for timestamp in timestamps]
+        buckets = downsample(timestamps, values, 0, 100, 4)
+        assert len(buckets) == 4
+        assert buckets[0] == (0, 0, 9, pytest.approx(4))
+        assert [bucket[0] for bucket in buckets] == [0, 25, 50, 75]
+
+    def test_sparse(self):
+        buckets = downsample([10, 90], [1, 2], 0, 100, 10)
+        assert buckets == [(10, 1, 1, 1), (90, 2, 2, 2)]
+
+    def test_empty(self):
+        assert downsample([], [], 0, 100, 10) == []
+
+
+class TestMerge:
+
+    def test_weighted_mean(self):
+        rollups = [(0, 1, 5, 2, 3), (3600, 0, 10, 6, 1), (7200, 4, 4, 4, 2)]
+        assert merge(rollups, 0, 10800, 2) == [(0, 0, 10, 3), (5400, 4, 4, 4)]
+        assert merge([], 0, 100, 10) == []
@@ -0,0 +1,128 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+
+import connexion
+import pytest
+
+from wattpilot.server import RequestTimeoutMiddleware, StreamLimitMiddleware, set_workers
+
+
+def run(app, timeout):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def call():
+        middleware = RequestTimeoutMiddleware(app, timeout)
+        await middleware({"type": "http", "method": "GET", "path": "/"}, receive, send)
+        # Let a pending handler finish
+        await asyncio.sleep(0.05)
+
+    asyncio.run(call())
+    return messages
+
+
+async def respond(send, delay=0):
+    await asyncio.sleep(delay)
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+class TestRequestTimeoutMiddleware:
+
+    def test_in_time(self):
+        async def app(scope, receive, send):
+            await respond(send)
+
+        messages = run(app, 1)
+        assert messages[0]["status"] == 200
+        assert messages[1]["body"] == b"ok"
+
+    def test_timeout(self):
+        async def app(scope, receive, send):
+            await respond(send, delay=0.02)
+
+        messages = run(app, 0.01)
+        # The late response is discarded
+        assert len(messages) == 2
+        assert messages[0]["status"] == 503
+
+    def test_started_response_not_interrupted(self):
+        async def app(scope, receive, send):
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await asyncio.sleep(0.02)
+            await send({"type": "http.response.body", "body": b"late"})
+
+        messages = run(app, 0.01)
+        assert messages[0]["status"] == 200
+        assert messages[1]["body"] == b"late"
+
+
+class TestStreamLimitMiddleware:
+
+    def test_limit(self):
+        async def call():
+            closing = asyncio.Event()
+
+            async def app(scope, receive, send):
+                await send({"type": "http.response.start", "status": 200, "headers": []})
+                if scope["path"].endswith("/events"):
+                    await closing.wait()
+
+            async def request(path):
+                messages = []
+
+                async def send(message):
+                    messages.append(message)
+
+                task = asyncio.ensure_future(middleware({"type": "http", "method": "GET", "path": path}, None, send))
+                await asyncio.sleep(0.01)
+                return task, messages[0]["status"]
+
+            middleware = StreamLimitMiddleware(app, 2)
+            streams = [await request("/v1/events") for _ in range(3)]
+            # The third stream is refused, the other requests are still served
+            assert [status for _, status in streams] == [200, 200, 503]
+            assert (await request("/v1/status"))[1] == 200
+            closing.set()
+            await asyncio.gather(*(task for task, _ in streams))
+            # Closed streams free their place
+            assert middleware.streams == 0
+            assert (await request("/v1/events"))[1] == 200
+
+        asyncio.run(call())
+
+
+class TestSetWorkers:
+
+    def test_thread_pool(self):
+        # Relies on connexion internals, this fails if an upgrade moves the pool
+        app = connexion.FlaskApp(__name__)
+        set_workers(app, 3)
+        assert app._middleware_app.asgi_app.executor._max_workers == 3
+
+    def test_unsupported(self, mocker):
+        app = connexion.FlaskApp(__name__)
+        mocker.patch.object(app._middleware_app, "asgi_app", mocker.Mock())
+        with pytest.raises(RuntimeError):
+            set_workers(app, 3)
@@ -0,0 +1,119 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import connexion
+import pytest
+
+from wattpilot.app import WattPilotApp
+from wattpilot.status import Status
+
+
+@pytest.fixture
+def status(mocker):
+    status = Status()
+    mocker.patch("wattpilot.app.status", status)
+    mocker.patch.object(WattPilotApp, "_WattPilotApp__status_cache", (None, None))
+    return status
+
+
+@pytest.fixture
+def client(mocker, status):
+    mocker.patch.object(WattPilotApp, "wattpilot")
+    app = connexion.FlaskApp(__name__, specification_dir="../openapi")
+    app.add_api("swagger.yaml")
+    return app.test_client()
+
+
+class TestStatus:
+
+    def test_update(self):
+        status = Status()
+        etag, snapshot = status.get()
+        status.update(state="idle", loads=(1, 2))
+        new_etag, new_snapshot = status.get()
+        assert new_etag != etag
+        assert new_snapshot == {"state": "idle", "loads": (1, 2)}
+        # The previous snapshot is left untouched
+        assert snapshot == {}
+        with pytest.raises(TypeError):
+            new_snapshot["state"] = "force"
+
+    def test_update_unchanged(self):
+        status = Status()
+        status.update(state="idle", power=-200)
+        etag, snapshot = status.get()
+        status.update(state="idle")
+        assert status.get() == (etag, snapshot)
+        status.update(power=-250)
+        assert status.get()[0] != etag
+
+    def test_get_status(self, client, status):
+        status.update(state="solar", loads=(2,), power=-1500.0, power_timestamp=1591531200,
+                      cloudiness=80, cloudiness_level=75, forecast_timestamp=1591531200)
+        # Decided on the mean over the forecast window, not the next slot
+        status.update(decision_cloudiness=60.4, will_run=False)
+        response = client.get("/v1/status")
+        assert response.status_code == 200
+        body = response.json()
+        assert body["state"] == "solar"
+        assert body["loads"] == [{"pin": 2, "state": True}]
+        assert body["power"]["power"] == -1500.0
+        assert body["temperature"]["temperature"] is None
+        assert body["weather"] == {"cloudiness": 60, "will_run": False, "timestamp": "2020-06-07T12:00:00+00:00"}
+        etag = response.headers["ETag"]
+        response = client.get("/v1/status", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        status.update(state="idle")
+        response = client.get("/v1/status", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json()["state"] == "idle"
+        # Served without any message to the actors
+        assert not WattPilotApp.wattpilot.mock_calls
+
+    def test_subscribe(self):
+        status = Status()
+        status.update(state="idle")
+        subscription = status.subscribe(maxlen=3)
+        status.update(power=-100)
+        status.update(power=-100)
+        assert subscription.get(timeout=0) == [(1, {"state": "idle"}), (2, {"power": -100})]
+        assert subscription.get(timeout=0) == []
+        subscription.close()
+        status.update(power=-200)
+        assert subscription.get(timeout=0) == []
+
+    def test_subscribe_drop_oldest(self):
+        status = Status()
+        subscription = status.subscribe(maxlen=3)
+        for power in range(5):
+            status.update(power=power)
+        assert subscription.get(timeout=0) == [(3, {"power": 2}), (4, {"power": 3}), (5, {"power": 4})]
+        assert subscription.dropped == 3
+
+    def test_get_events(self, mocker, status):
+        mocker.patch.object(WattPilotApp, "EVENTS_KEEP_ALIVE", 0)
+        status.update(state="idle")
+        response = WattPilotApp.get_events()
+        assert response.mimetype == "text/event-stream"
+        stream = response.response
+        assert next(stream) == 'id: 1\nevent: status\ndata: {"state": "idle"}\n\n'
+        assert next(stream) == ": keep-alive\n\n"
+        status.update(state="solar", loads=(1,))
+        assert next(stream) == 'id: 2\nevent: status\ndata: {"state": "solar", "loads": [1]}\n\n'
+        stream.close()
+        status.update(state="idle")
+        assert not status._Status__subscriptions
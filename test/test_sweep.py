@@ -0,0 +1,76 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import pytest
+
+from wattpilot.replay import get_loads, replay
+
+np = pytest.importorskip("numpy")
+sweep = pytest.importorskip("wattpilot.sweep")
+
+
+@pytest.fixture
+def model(config, day):
+    return sweep.Model(day, get_loads(config), 2, 6)
+
+
+class TestSweep:
+
+    def test_parse_values(self):
+        assert list(sweep.parse_values("200")) == [200]
+        assert list(sweep.parse_values("1,2.5")) == [1, 2.5]
+        assert list(sweep.parse_values("0:100:50")) == [0, 50, 100]
+        with pytest.raises(ValueError, match="Invalid step"):
+            sweep.parse_values("0:100:0")
+
+    def test_combine(self):
+        combinations = sweep.combine([np.array([1, 2]), np.array([3]), np.array([4, 5, 6])])
+        assert combinations.shape == (6, 3)
+        assert list(combinations[-1]) == [2, 3, 6]
+
+    def test_same_as_replay(self, config, day, model):
+        results = model.simulate([[200, 0, 60, 50, 75]])
+        report = replay(config, day)
+        assert results["switches"][0] == report["switches"]
+        # A decision on every sample of the trace instead of every power sample
+        assert results["diverted"][0] == pytest.approx(report["diverted"], rel=0.01)
+        assert results["imported"][0] == pytest.approx(report["imported"], rel=0.01)
+
+    def test_parameters(self, model):
+        results = model.simulate([
+            [200, 0, 60, 50, 75],
+            # Too sunny tomorrow for the schedule
+            [200, 0, 60, 50, 95],
+            # Never enough exported power
+            [5000, 0, 60, 50, 75],
+        ])
+        assert list(results["switches"]) == [8, 4, 4]
+        assert results["diverted"][1] == pytest.approx(results["diverted"][0] - 12000)
+        assert results["solar"][2] == 0
+
+    def test_sweep(self, model):
+        combinations = sweep.combine([sweep.parse_values("0:1000:250"), np.array([0, 500]), np.array([60]),
+                                      np.array([50]), np.array([75, 95])])
+        results = sweep.sweep(model, combinations, workers=2)
+        expected = model.simulate(combinations)
+        for key, values in expected.items():
+            assert list(results[key]) == pytest.approx(list(values))
+        front = sweep.pareto(results)
+        assert [results["switches"][index] for index in front] == sorted({results["switches"][i] for i in front})
+        table = sweep.format_table(combinations, results, front, model.surplus())
+        assert table.startswith("switches\tself_consumption\t")
+        assert len(table.splitlines()) == len(front) + 1
@@ -16,11 +16,13 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import configparser
+import threading
+import time
 
 import pykka
 import pytest
 
-from wattpilot.device import TempSensorDevice
+from wattpilot.device import TempSensorDevice, TempSensorGroup
 from wattpilot.temperature import Temperature
 
 
@@ -36,21 +38,166 @@ def config():
 
 
 @pytest.fixture
-def temperature_sensor(mocker):
-    return mocker.Mock(spec=TempSensorDevice)
+def readings():
+    return {"boiler": None}
+
+
+# When the sensors were read
+READ_TIME = 1591516800
 
 
 @pytest.fixture
-def temperature(mocker, config, temperature_sensor):
-    proxy = Temperature.start(config, temperature_sensor).proxy()
+def temperature_sensors(mocker, readings):
+    def read(callback):
+        callback({name: (value, None if value is None else READ_TIME) for name, value in readings.items()})
+
+    sensors = mocker.Mock(spec=TempSensorGroup, names=["boiler"])
+    sensors.read.side_effect = read
+    return sensors
+
+
+@pytest.fixture
+def temperature(mocker, config, temperature_sensors):
+    proxy = Temperature.start(config, temperature_sensors).proxy()
     yield proxy
     pykka.ActorRegistry.stop_all()
 
 
+def sensor(mocker, value=None, delay=0):
+    def read():
+        time.sleep(delay)
+        return value
+    return mocker.Mock(spec=TempSensorDevice, **{"value.side_effect": read})
+
+
+def read(group):
+    done = threading.Event()
+    result = {}
+
+    def callback(readings):
+        result.update((name, value) for name, (value, _) in readings.items())
+        done.set()
+
+    group.read(callback)
+    assert done.wait(1)
+    return result
+
+
 class TestTemperature:
 
     @pytest.mark.parametrize("value", [0, 10, 22.2, 56.7, 100])
-    def test_read_temperature(self, value, temperature, temperature_sensor):
-        temperature_sensor.value.return_value = value
-        temperature.run.defer()
+    def test_read_temperature(self, value, temperature, readings):
+        readings["boiler"] = value
+        temperature.run().get()
         assert temperature.get_temperature().get() == value
+
+    def test_subscribe(self, mocker, temperature, readings):
+        callback = mocker.Mock()
+        readings["boiler"] = 42
+        temperature.subscribe(callback).get()
+        callback.defer.assert_not_called()
+        temperature.run().get()
+        temperature.get_temperature().get()
+        callback.defer.assert_called_once_with(42, READ_TIME)
+        # A new subscriber gets the last reading right away
+        late = mocker.Mock()
+        temperature.subscribe(late).get()
+        late.defer.assert_called_once_with(42, mocker.ANY)
+
+    def test_last_good_value_not_published_again(self, mocker, temperature, readings):
+        callback = mocker.Mock()
+        temperature.subscribe(callback).get()
+        readings["boiler"] = 42
+        temperature.run().get()
+        # The sensor did not answer, the group hands back the value read before
+        temperature.run().get()
+        temperature.get_temperature().get()
+        callback.defer.assert_called_once_with(42, READ_TIME)
+
+    def test_read_temperature_failure(self, mocker, temperature):
+        callback = mocker.Mock()
+        temperature.subscribe(callback).get()
+        temperature.run().get()
+        assert temperature.get_temperature().get() == 100
+        callback.defer.assert_not_called()
+
+    def test_control_sensor(self, mocker, config, temperature_sensors, readings):
+        config.read_string("""
+            [temperature]
+            sensor = bottom
+        """)
+        readings.update(top=60, bottom=30)
+        temperature = Temperature.start(config, temperature_sensors).proxy()
+        try:
+            temperature.run().get()
+            assert temperature.get_temperature().get() == 30
+            assert temperature.get_temperatures().get() == {"boiler": None, "top": 60, "bottom": 30}
+        finally:
+            temperature.stop()
+
+
+class TestTempSensorGroup:
+
+    def test_from_config(self, mocker, config):
+        device = mocker.Mock()
+        assert TempSensorGroup.from_config(config, device).names == ["boiler"]
+        device.assert_called_once_with("boiler", "28-0416350909ff")
+        config.read_string("""
+            [sensor_top]
+            address = 28-1
+            offset = 0.5
+            timeout = 5
+
+            [sensor_bottom]
+            address = 28-2
+        """)
+        assert TempSensorGroup.from_config(config, device).names == ["bottom", "top"]
+        device.assert_called_with("top", "28-1", 0.5)
+
+    def test_read_time(self, mocker):
+        clock = mocker.Mock(return_value=1000)
+        group = TempSensorGroup({"a": sensor(mocker, 1)}, clock=clock)
+        done = threading.Event()
+        result = {}
+        group.read(lambda readings: result.update(readings) or done.set())
+        assert done.wait(1)
+        assert result == {"a": (1, 1000)}
+        group.close()
+
+    def test_timeout_per_sensor(self, mocker):
+        group = TempSensorGroup({"fast": sensor(mocker, 10, 0.1), "slow": sensor(mocker, 20, 0.1)}, timeout=0.5,
+                                timeouts={"fast": 0.02})
+        assert read(group) == {"fast": None, "slow": 20}
+        group.close()
+
+    def test_read_concurrently(self, mocker):
+        group = TempSensorGroup({name: sensor(mocker, value, 0.2) for name, value in [("a", 1), ("b", 2), ("c", 3)]})
+        start = time.monotonic()
+        assert read(group) == {"a": 1, "b": 2, "c": 3}
+        assert time.monotonic() - start < 0.5
+        group.close()
+
+    def test_timeout_keeps_last_value(self, mocker):
+        slow = sensor(mocker, 20)
+        group = TempSensorGroup({"fast": sensor(mocker, 10), "slow": slow}, timeout=0.05)
+        assert read(group) == {"fast": 10, "slow": 20}
+        slow.value.side_effect = lambda: time.sleep(0.2) or 21
+        assert read(group) == {"fast": 10, "slow": 20}
+        # Still busy, not read again
+        assert read(group) == {"fast": 10, "slow": 20}
+        assert slow.value.call_count == 2
+        time.sleep(0.2)
+        assert read(group) == {"fast": 10, "slow": 21}
+        group.close()
+
+    def test_failure_keeps_last_value(self, mocker):
+        flaky = sensor(mocker, 20)
+        clock = mocker.Mock(return_value=0)
+        group = TempSensorGroup({"flaky": flaky}, max_age=60, clock=clock)
+        assert read(group) == {"flaky": 20}
+        flaky.value.side_effect = [None, OSError]
+        clock.return_value = 60
+        assert read(group) == {"flaky": 20}
+        clock.return_value = 61
+        assert read(group) == {"flaky": None}
+        group.close()
@@ -16,16 +16,23 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import configparser
+import json
 import time
+from datetime import UTC, datetime
+from typing import Final
 
 import pykka
 import pytest
 from freezegun import freeze_time
 
+from wattpilot.actor import WattPilotActor
+from wattpilot.clock import VirtualClock
+from wattpilot.engine import CircuitOpenError, Response
 from wattpilot.fronius import Fronius
 from wattpilot.openweathermap import OpenWeatherMap
+from wattpilot.status import status
 from wattpilot.temperature import Temperature
-from wattpilot.wattpilot import WattPilot
+from wattpilot.wattpilot import AllLoad, Load, LoadSnapshot, WattPilot
 
 
 @pytest.fixture
@@ -64,6 +71,7 @@ def config():
         [temperature]
         temperature_schedule = 50
         temperature_solar = 60
+        max_age = 86400
 
         [load_1]
         power = 1000
@@ -83,12 +91,44 @@ def wattpilot(mocker, config, power, gpio, weather, temperature):
     WattPilot.DEFAULT_DELAY = 0.01
     with freeze_time("1981-05-30 00:00:01"):
         wattpilot = WattPilot.start(config, power, gpio, weather, temperature).proxy()
+        wattpilot.set_temperature(50, now()).get()
         yield wattpilot
         wattpilot.halt.defer()
         assert wattpilot.is_halt().get()
         pykka.ActorRegistry.stop_all()
 
 
+@pytest.fixture
+def virtual_clock(mocker):
+    clock = VirtualClock(datetime(1981, 5, 30, tzinfo=UTC))
+    mocker.patch.object(WattPilotActor, "clock", clock)
+    mocker.patch.object(WattPilot, "DEFAULT_DELAY", 60)
+    yield clock
+    pykka.ActorRegistry.stop_all()
+
+
+class House:
+    # Grid power seen by the inverter: a base consumption, the sun from 10h to 16h and the loads
+    LOADS: Final = {1: 1000, 2: 2000}
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.pins = {}
+
+    def set_pins(self, values):
+        self.pins.update(values)
+
+    def respond(self, request):
+        production = 4000 if 10 <= self.clock.now().hour < 16 else 0
+        consumption = sum(power for pin, power in House.LOADS.items() if self.pins.get(pin))
+        grid = 300 + consumption - production
+        return Response(200, {}, json.dumps({"Body": {"Data": {"Site": {"P_Grid": grid}}}}).encode("ascii"))
+
+
+def now():
+    return datetime.now(tz=UTC).timestamp()
+
+
 def wait_with_timeout(method, timeout=1):
     start = time.time()
     while not method():
@@ -103,10 +143,16 @@ class FakeFuture:
     def __init__(self, value):
         self.value = value
 
-    def get(self):
+    def get(self, timeout=None):
         return self.value
 
 
+class SlowFuture:
+
+    def get(self, timeout=None):
+        raise pykka.Timeout
+
+
 class PowerFirstThen:
     latch = True
 
@@ -125,146 +171,344 @@ class PowerFirstThen:
 class TestWattPilot:
 
     def test_idle_not_enough_power(self, mocker, wattpilot, power):
-        power.get_power.return_value = FakeFuture(0)
         wattpilot.idle.defer()
         assert wattpilot.is_idle().get()
 
     def test_idle_enough_power_for_one_load(self, mocker, wattpilot, gpio, power):
-        power.get_power.return_value = FakeFuture(-2000)
         wattpilot.idle.defer()
-        wattpilot.update_power().get()
+        wattpilot.set_power(-2000, now()).get()
         assert wattpilot.is_solar().get()
-        wattpilot.update_power().get()
-        gpio.set_pin.assert_has_calls([mocker.call(1, True)])
+        wattpilot.set_power(-2000, now()).get()
+        gpio.set_pins.assert_has_calls([mocker.call({1: True})])
+        # The samples are pushed, no round trip back to the power source
+        power.get_power.assert_not_called()
 
     def test_idle_enough_power_for_one_load_then_temperature_high(self, mocker, wattpilot, gpio,
                                                                   power, temperature):
-        power.get_power.return_value = FakeFuture(-2000)
         wattpilot.idle.defer()
-        wattpilot.update_power().get()
+        wattpilot.set_power(-2000, now()).get()
         assert wattpilot.is_solar().get()
-        wattpilot.update_power().get()
-        gpio.set_pin.assert_has_calls([mocker.call(1, True)])
-        temperature.get_temperature.return_value = FakeFuture(60.51)
-        wattpilot.update_power().get()
+        wattpilot.set_power(-2000, now()).get()
+        gpio.set_pins.assert_has_calls([mocker.call({1: True})])
+        wattpilot.set_temperature(60.51, now()).get()
+        wattpilot.set_power(-2000, now()).get()
         assert wattpilot.is_idle().get()
 
+    def test_idle_enough_power_stale(self, mocker, wattpilot, gpio):
+        wattpilot.idle.defer()
+        wattpilot.set_power(-2000, now() - 181, repeated=True).get()
+        assert wattpilot.is_idle().get()
+
+    def test_solar_power_stale(self, mocker, wattpilot, gpio):
+        wattpilot.idle.defer()
+        wattpilot.set_power(-2000, now()).get()
+        assert wattpilot.is_solar().get()
+        wattpilot.set_power(-2000, now()).get()
+        gpio.set_pins.assert_has_calls([mocker.call({1: True})])
+        # The power source could not be reached for a while, it pushes its last reading again
+        wattpilot.set_power(-2000, now() - 181, repeated=True).get()
+        assert wattpilot.is_idle().get()
+        gpio.set_pins.assert_called_with({1: False})
+
+    def test_idle_enough_power_temperature_stale(self, mocker, wattpilot, gpio, temperature):
+        temperature.subscribe.defer.assert_called_once()
+        wattpilot.set_temperature(40, now() - 86401).get()
+        wattpilot.idle.defer()
+        wattpilot.set_power(-2000, now()).get()
+        assert wattpilot.is_idle().get()
+        temperature.get_temperature.assert_not_called()
+
     def test_idle_enough_power_for_two_loads(self, mocker, wattpilot, gpio, power):
-        power.get_power.return_value = FakeFuture(-3000)
         wattpilot.idle.defer()
-        wattpilot.update_power().get()
+        wattpilot.set_power(-3000, now()).get()
+        assert wattpilot.is_solar().get()
+        wattpilot.set_power(-3000, now()).get()
+        wattpilot.set_power(-3000, now()).get()
+        gpio.set_pins.assert_has_calls([mocker.call({2: True}), mocker.call({1: True})])
+
+    def test_enough_power_for_two_loads_at_once(self, mocker, wattpilot, gpio, power):
+        wattpilot.idle.defer()
+        wattpilot.set_power(-3500, now()).get()
         assert wattpilot.is_solar().get()
-        wattpilot.update_power().get()
-        wattpilot.update_power().get()
-        gpio.set_pin.assert_has_calls([mocker.call(2, True), mocker.call(1, True)])
+        wattpilot.set_power(-3500, now()).get()
+        assert gpio.set_pins.call_args_list == [mocker.call({1: True, 2: True})]
+        # 1500W short, only the first load still fits
+        gpio.set_pins.reset_mock()
+        wattpilot.set_power(1500, now()).get()
+        assert gpio.set_pins.call_args_list == [mocker.call({2: False})]
 
     def test_enough_power_for_two_loads_then_one(self, mocker, wattpilot, gpio, power):
-        power.get_power.return_value = FakeFuture(-3000)
         wattpilot.idle.defer()
-        wattpilot.update_power().get()
+        wattpilot.set_power(-3000, now()).get()
         assert wattpilot.is_solar().get()
-        wattpilot.update_power().get()
-        wattpilot.update_power().get()
-        gpio.set_pin.assert_has_calls([mocker.call(2, True), mocker.call(1, True)])
-        gpio.set_pin.reset_mock()
-        power.get_power.return_value = FakeFuture(500)
-        wattpilot.update_power().get()
-        wattpilot.update_power().get()
-        gpio.set_pin.assert_has_calls([mocker.call(1, False), mocker.call(2, False)])
-        wattpilot.update_power().get()
+        wattpilot.set_power(-3000, now()).get()
+        wattpilot.set_power(-3000, now()).get()
+        gpio.set_pins.assert_has_calls([mocker.call({2: True}), mocker.call({1: True})])
+        gpio.set_pins.reset_mock()
+        wattpilot.set_power(500, now()).get()
+        wattpilot.set_power(500, now()).get()
+        gpio.set_pins.assert_has_calls([mocker.call({1: False}), mocker.call({2: False, 1: True})])
+        wattpilot.set_power(500, now()).get()
         assert wattpilot.is_idle().get()
 
     def test_two_loads_then_one_and_two(self, mocker, wattpilot, gpio, power):
-        power.get_power.return_value = FakeFuture(-3000)
         wattpilot.idle.defer()
-        wattpilot.update_power().get()
+        wattpilot.set_power(-3000, now()).get()
         assert wattpilot.is_solar().get()
-        wattpilot.update_power().get()
-        wattpilot.update_power().get()
-        gpio.set_pin.assert_has_calls([mocker.call(2, True), mocker.call(1, True)])
+        wattpilot.set_power(-3000, now()).get()
+        wattpilot.set_power(-3000, now()).get()
+        gpio.set_pins.assert_has_calls([mocker.call({2: True}), mocker.call({1: True})])
         # No more power
-        gpio.set_pin.reset_mock()
-        power.get_power.return_value = FakeFuture(500)
-        wattpilot.update_power().get()
-        gpio.set_pin.assert_has_calls([mocker.call(1, False)])
+        gpio.set_pins.reset_mock()
+        wattpilot.set_power(500, now()).get()
+        gpio.set_pins.assert_has_calls([mocker.call({1: False})])
         # Power available again
-        gpio.set_pin.reset_mock()
-        power.get_power.return_value = FakeFuture(-2000)
-        wattpilot.update_power().get()
-        gpio.set_pin.assert_has_calls([mocker.call(1, True)])
+        gpio.set_pins.reset_mock()
+        wattpilot.set_power(-2000, now()).get()
+        gpio.set_pins.assert_has_calls([mocker.call({1: True})])
 
     def test_force(self, mocker, wattpilot, gpio, power):
-        power.get_power.return_value = FakeFuture(0)
         wattpilot.idle.defer()
         wattpilot.force.defer()
         assert wattpilot.is_force().get()
-        gpio.set_pin.assert_has_calls([mocker.call(1, True), mocker.call(2, True)])
+        gpio.set_pins.assert_has_calls([mocker.call({1: True, 2: True})])
 
     def test_schedule_no_trigger(self, mocker, wattpilot, gpio, power, weather):
-        power.get_power.return_value = FakeFuture(0)
         weather.get_cloudiness.return_value = FakeFuture(0)
         wattpilot.idle.defer()
         wattpilot.set_schedule_trigger(False).get()
         with freeze_time("1981-05-30 02:00:01", tick=True):
-            wattpilot.update_power().get()
+            wattpilot.set_power(0, now()).get()
             assert wattpilot.is_idle().get()
-        assert gpio.set_pin.call_count == 0
+        assert gpio.set_pins.call_count == 0
 
     def test_schedule_trigger_set(self, mocker, wattpilot, gpio, power, weather, temperature):
-        power.get_power.return_value = FakeFuture(0)
         weather.get_cloudiness.return_value = FakeFuture(0)
-        temperature.get_temperature.return_value = FakeFuture(40)
+        wattpilot.set_temperature(40, now()).get()
         wattpilot.idle.defer()
         wattpilot.set_schedule_trigger(True).get()
         with freeze_time("1981-05-30 02:00:01", tick=True):
-            wattpilot.update_power().get()
+            wattpilot.set_power(0, now()).get()
             assert wattpilot.is_schedule().get()
-        gpio.set_pin.assert_has_calls([mocker.call(1, True), mocker.call(2, True)])
+        gpio.set_pins.assert_has_calls([mocker.call({1: True, 2: True})])
 
     def test_schedule_start_and_stop(self, mocker, wattpilot, gpio, power, temperature):
-        power.get_power.return_value = FakeFuture(0)
-        temperature.get_temperature.return_value = FakeFuture(40)
+        wattpilot.set_temperature(40, now()).get()
         wattpilot.idle.defer()
         # Start
         wattpilot.set_schedule_trigger(True).get()
         with freeze_time("1981-05-30 02:00:01", tick=True):
-            wattpilot.update_power().get()
+            wattpilot.set_power(0, now()).get()
             assert wattpilot.is_schedule().get()
-        gpio.set_pin.assert_has_calls([mocker.call(1, True), mocker.call(2, True)])
+        gpio.set_pins.assert_has_calls([mocker.call({1: True, 2: True})])
         # Stop
-        gpio.set_pin.reset_mock()
+        gpio.set_pins.reset_mock()
         with freeze_time("1981-05-30 06:00:01", tick=True):
             wait_with_timeout(lambda: wattpilot.is_idle().get())
-        gpio.set_pin.assert_has_calls([mocker.call(1, False), mocker.call(2, False)])
+        gpio.set_pins.assert_has_calls([mocker.call({1: False, 2: False})])
 
     def test_schedule_no_trigger_sunny_tomorrow(self, mocker, wattpilot, gpio, power, weather):
-        power.get_power.return_value = FakeFuture(0)
         wattpilot.idle.defer()
         wattpilot.set_schedule_trigger(False).get()
         weather.get_cloudiness.return_value = FakeFuture(0)
         with freeze_time("1981-05-30 02:00:01", tick=True):
-            wattpilot.update_power().get()
+            wattpilot.set_power(0, now()).get()
             assert wattpilot.is_idle().get()
-        assert gpio.set_pin.call_count == 0
+        assert gpio.set_pins.call_count == 0
 
     def test_schedule_no_trigger_not_sunny_tomorrow(self, mocker, wattpilot, gpio, power, weather,
                                                     temperature):
-        power.get_power.return_value = FakeFuture(0)
-        temperature.get_temperature.return_value = FakeFuture(40)
+        wattpilot.set_temperature(40, now()).get()
         wattpilot.idle.defer()
         wattpilot.set_schedule_trigger(False).get()
         weather.get_cloudiness.return_value = FakeFuture(100)
         with freeze_time("1981-05-30 02:00:01", tick=True):
-            wattpilot.update_power().get()
+            wattpilot.set_power(0, now()).get()
             assert wattpilot.is_schedule().get()
-        gpio.set_pin.assert_has_calls([mocker.call(1, True), mocker.call(2, True)])
+        gpio.set_pins.assert_has_calls([mocker.call({1: True, 2: True})])
 
     def test_schedule_no_trigger_not_sunny_tomorrow_temperature_high(self, mocker, wattpilot, gpio,
                                                                      power, weather, temperature):
-        power.get_power.return_value = FakeFuture(0)
         wattpilot.idle.defer()
         wattpilot.set_schedule_trigger(False).get()
         weather.get_cloudiness.return_value = FakeFuture(100)
         with freeze_time("1981-05-30 02:00:01", tick=True):
-            wattpilot.update_power().get()
+            wattpilot.set_power(0, now()).get()
+            assert wattpilot.is_idle().get()
+
+    def test_schedule_weather_slow(self, mocker, wattpilot, gpio, weather):
+        wattpilot.idle.defer()
+        wattpilot.set_schedule_trigger(False).get()
+        weather.get_cloudiness.return_value = FakeFuture(0)
+        with freeze_time("1981-05-30 02:00:01", tick=True):
+            wattpilot.set_power(0, now()).get()
+            assert wattpilot.is_idle().get()
+            # Keep the last known cloudiness if the weather does not answer in time
+            weather.get_cloudiness.return_value = SlowFuture()
+            wattpilot.set_power(0, now()).get()
             assert wattpilot.is_idle().get()
+        assert gpio.set_pins.call_count == 0
+
+    def test_schedule_forecast_window(self, mocker, config, power, gpio, weather, temperature):
+        config.set("main", "forecast_start", "9")
+        config.set("main", "forecast_stop", "17")
+        weather.get_cloudiness.return_value = FakeFuture(100)
+        with freeze_time("1981-05-30 02:00:01"):
+            wattpilot = WattPilot.start(config, power, gpio, weather, temperature).proxy()
+            assert wattpilot.get_scheduled_by_weather().get()
+        assert status.get()[1]["will_run"]
+        with freeze_time("1981-05-30 18:00:00"):
+            wattpilot.get_scheduled_by_weather().get()
+        pykka.ActorRegistry.stop_all()
+        start = datetime(1981, 5, 30, 9, tzinfo=UTC).timestamp()
+        weather.get_cloudiness.assert_has_calls([
+            mocker.call(start, start + 8 * 3600),
+            mocker.call(start + 86400, start + 86400 + 8 * 3600),
+        ])
+
+    def test_state_history(self, mocker, wattpilot):
+        wattpilot.idle.defer()
+        wattpilot.force.defer()
+        assert wattpilot.is_force().get()
+        history = wattpilot.get_state_history(0, now() + 1).get()
+        assert [state for _, state in history] == ["idle", "force"]
+        assert wattpilot.get_state_history(now() + 1, now() + 2).get() == [(mocker.ANY, "force")]
+
+    def test_active_loads(self, virtual_clock, config, power, gpio, weather, temperature):
+        wattpilot = WattPilot.start(config, power, gpio, weather, temperature).proxy()
+        wattpilot.idle.defer()
+        wattpilot.force().get()
+        start = virtual_clock.now().timestamp()
+        first = wattpilot.get_active_loads().get()
+        assert first == (LoadSnapshot(1, 1000, start, 0), LoadSnapshot(2, 2000, start, 0))
+        virtual_clock.advance(3600)
+        wattpilot.idle().get()
+        assert wattpilot.get_active_loads().get() == ()
+        wattpilot.force().get()
+        # The energy used so far is counted on every switch
+        assert wattpilot.get_active_loads().get() == (LoadSnapshot(1, 1000, start + 3600, 1000),
+                                                      LoadSnapshot(2, 2000, start + 3600, 2000))
+        # Snapshots handed out are never modified
+        assert first[0].since == start
+
+    def test_verify_outputs(self, virtual_clock, config, power, gpio, weather, temperature):
+        config.read_string("""
+            [main]
+            gpio_verify_interval = 300
+        """)
+        wattpilot = WattPilot.start(config, power, gpio, weather, temperature).proxy()
+        wattpilot.idle.defer()
+        wattpilot.force().get()
+        gpio.verify.assert_not_called()
+        # The loads stay on, the outputs are still read back
+        virtual_clock.advance(900)
+        assert gpio.verify.call_count == 3
+        assert wattpilot.is_force().get()
+
+    def test_virtual_day(self, mocker, virtual_clock, config, gpio, weather, temperature, http):
+        config.read_string("""
+            [main]
+            fronius_host = fronius
+            fronius_power_source = powerflow
+        """)
+        house = House(virtual_clock)
+        gpio.set_pins.side_effect = house.set_pins
+        http.response = house.respond
+        weather.get_cloudiness.return_value = FakeFuture(100)
+        power = Fronius.start(config).proxy()
+        wattpilot = WattPilot.start(config, power, gpio, weather, temperature).proxy()
+        wattpilot.set_temperature(40, virtual_clock.now().timestamp()).get()
+        wattpilot.idle.defer()
+        virtual_clock.advance(23 * 3600)
+        history = wattpilot.get_state_history(0, virtual_clock.now().timestamp()).get()
+        assert [(datetime.fromtimestamp(timestamp, tz=UTC).hour, state) for timestamp, state in history] == [
+            (0, "idle"), (2, "schedule"), (6, "idle"), (10, "solar"), (16, "idle")]
+        # Both loads are switched at once, on schedule then on the sun
+        assert gpio.set_pins.call_args_list == [mocker.call({1: True, 2: True}), mocker.call({1: False, 2: False})] * 2
+        assert house.pins == {1: False, 2: False}
+
+
+    def test_outage_after_switch(self, mocker, virtual_clock, config, gpio, weather, temperature, http):
+        config.read_string("""
+            [main]
+            fronius_host = fronius
+            fronius_power_source = powerflow
+        """)
+        # One sample for idle, one for solar, then the inverter is unreachable
+        samples = iter([-2200, -2200])
+
+        def respond(request):
+            grid = next(samples, None)
+            if grid is None:
+                return CircuitOpenError("open")
+            return Response(200, {}, json.dumps({"Body": {"Data": {"Site": {"P_Grid": grid}}}}).encode("ascii"))
+
+        http.response = respond
+        power = Fronius.start(config).proxy()
+        wattpilot = WattPilot.start(config, power, gpio, weather, temperature).proxy()
+        wattpilot.set_temperature(40, virtual_clock.now().timestamp()).get()
+        wattpilot.idle.defer()
+        virtual_clock.advance(170)
+        assert wattpilot.is_solar().get()
+        # The last sample pushed again is not used a second time
+        assert gpio.set_pins.call_args_list == [mocker.call({2: True})]
+        virtual_clock.advance(20)
+        assert wattpilot.is_idle().get()
+        assert gpio.set_pins.call_args_list == [mocker.call({2: True}), mocker.call({2: False})]
+
+    def test_solar_watchdog(self, mocker, virtual_clock, config, power, gpio, weather, temperature):
+        wattpilot = WattPilot.start(config, power, gpio, weather, temperature).proxy()
+        wattpilot.set_temperature(40, virtual_clock.now().timestamp()).get()
+        wattpilot.idle.defer()
+        wattpilot.set_power(-2200, virtual_clock.now().timestamp()).get()
+        virtual_clock.advance(1)
+        wattpilot.set_power(-2200, virtual_clock.now().timestamp()).get()
+        assert gpio.set_pins.call_args_list == [mocker.call({2: True})]
+        # No message at all from the power source
+        virtual_clock.advance(181)
+        assert wattpilot.is_idle().get()
+        assert gpio.set_pins.call_args_list == [mocker.call({2: True}), mocker.call({2: False})]
+
+class TestAllLoad:
+
+    @pytest.fixture
+    def loads(self, gpio):
+        loads = AllLoad(gpio)
+        for pin, power in zip([1, 2, 3], [2000, 1000, 3000], strict=True):
+            load = Load(gpio, pin)
+            load.power = power
+            loads.add_load(load)
+        return loads
+
+    def test_sets(self, loads):
+        assert loads.get_all() == 0b111
+        assert loads.get_pins(0b101) == (1, 3)
+        assert loads.get_inactive(0b101) == 0b010
+        assert loads.get_power(0b101) == 5000
+        assert loads.get_power(0) == 0
+
+    def test_minimum(self, loads):
+        assert loads.get_minimum_load().pin == 2
+        assert loads.get_minimum_power(0) == 1000
+        assert loads.get_minimum_power(0b010) == 2000
+        assert loads.get_minimum_power(0b111) == 0
+
+    def test_too_many_loads(self, gpio):
+        loads = AllLoad(gpio)
+        for pin in range(AllLoad.MAX_LOADS):
+            loads.add_load(Load(gpio, pin))
+        assert len(loads.get_all_loads()) == AllLoad.MAX_LOADS
+        with pytest.raises(ValueError, match="At most 16 loads"):
+            loads.add_load(Load(gpio, 99))
+
+    def test_best_loads(self, loads):
+        assert loads.get_best_loads(4500, 0) == 0b110
+        assert loads.get_best_loads(6000, 0) == 0b111
+        assert loads.get_best_loads(500, 0) == 0
+        assert loads.get_best_loads(-100, 0) == 0
+
+    def test_best_loads_fewest_switches(self, loads):
+        # 3000W is either the third load or the first two
+        assert loads.get_best_loads(3500, 0) == 0b100
+        assert loads.get_best_loads(3500, 0b010) == 0b011
+        assert loads.get_best_loads(3500, 0b110) == 0b100
@@ -20,17 +20,22 @@ import configparser
 import logging.config
 import os
 import signal
+import sys
 import unittest.mock
 
 import connexion
 import flask_cors
 import pykka
 
+from wattpilot.actor import WattPilotActor
 from wattpilot.app import WattPilotApp
-from wattpilot.device import GpioDevice, TempSensorDevice
+from wattpilot.device import GpioDevice, TempSensorGroup
 from wattpilot.fronius import Fronius
+from wattpilot.history import History
 from wattpilot.openweathermap import OpenWeatherMap
 from wattpilot.pvoutput import PVOutput
+from wattpilot.replay import Trace, format_report, replay
+from wattpilot.server import serve
 from wattpilot.temperature import Temperature
 from wattpilot.wattpilot import WattPilot
 
@@ -58,32 +63,49 @@ def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--fake-devices", action="store_true", help="fake the underlying hardware")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--production", action="store_true", help="use the production HTTP server settings")
+    parser.add_argument("--threads", type=int, default=10, help="threads serving the requests (production)")
+    parser.add_argument("--keep-alive", type=int, default=5, help="keep-alive timeout in seconds (production)")
+    parser.add_argument("--request-timeout", type=float, default=30, help="request timeout in seconds (production)")
+    parser.add_argument("--replay", metavar="TRACE", help="replay a recorded CSV trace and report the results")
     args = parser.parse_args()
 
     configuration = config()
 
+    if args.replay:
+        with open(args.replay, newline="") as f:
+            sys.stdout.write(format_report(replay(configuration, Trace.from_csv(f))))
+        return
+
+    if configuration.has_section("history"):
+        WattPilotApp.history = History.start(configuration).proxy()
+        WattPilotApp.history.run.defer()
+
     power = Fronius.start(configuration).proxy()
     weather = OpenWeatherMap.start(configuration).proxy()
 
     if args.fake_devices:
         gpio = unittest.mock.Mock()
-        temperature_sensor = unittest.mock.Mock()
-        temperature_sensor.value.return_value = 56.7
+        temperature_sensors = TempSensorGroup.from_config(
+            configuration, lambda *args: unittest.mock.Mock(**{"value.return_value": 56.7}))
     else:
         gpio = GpioDevice()
-        temperature_sensor = TempSensorDevice("boiler", configuration.get("temperature", "address"))
+        temperature_sensors = TempSensorGroup.from_config(configuration)
 
-    temperature = Temperature.start(configuration, temperature_sensor).proxy()
+    temperature = Temperature.start(configuration, temperature_sensors).proxy()
     pvoutput = PVOutput.start(configuration, temperature).proxy()
     wattpilot = WattPilot.start(configuration, power, gpio, weather, temperature).proxy()
 
     WattPilotApp.wattpilot = wattpilot
+    WattPilotApp.fronius = power
     WattPilotApp.openweathermap = weather
     WattPilotApp.temperature = temperature
 
-    # Wait for the first temperature to be read
-    temperature.run().get()
-    pvoutput.run.defer()
+    temperature.run.defer()
+    # Leave time for the first temperature to be read
+    pvoutput.do_delay.defer(60, "run")
 
     wattpilot.idle.defer()
 
@@ -93,10 +115,15 @@ def main():
     flask_cors.CORS(app.app)
 
     try:
-        app.run(host="0.0.0.0", port=8080)
+        if args.production:
+            serve(app, args.host, args.port, threads=args.threads, keep_alive=args.keep_alive,
+                  timeout=args.request_timeout)
+        else:
+            app.run(host=args.host, port=args.port)
     finally:
         wattpilot.halt().get()
         pykka.ActorRegistry.stop_all()
+        WattPilotActor.http.stop()
         gpio.cleanup()
 
 
@@ -15,40 +15,71 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import bisect
+import collections
 import logging
-from datetime import UTC, datetime
-from threading import Timer
 
 import pykka
 
 # from transitions.extensions import HierarchicalGraphMachine as Machine
 from transitions.extensions import HierarchicalMachine as Machine
 
+from .clock import Clock
+from .engine import HttpEngine
+from .status import status
+
 logger = logging.getLogger(__name__)
 
 
 class WattPilotModel(Machine):
 
-    def __init__(self, *args, **kwargs):
+    HISTORY_SIZE = 1000
+
+    def __init__(self, *args, clock, **kwargs):
         kwargs.setdefault("before_state_change", []).extend(
             ["do_cancel", self.__update_state_time])
+        kwargs.setdefault("after_state_change", []).append(self.__publish_state)
         super().__init__(
             auto_transitions=False,
             ignore_invalid_triggers=True,
             *args,
             **kwargs
         )
+        self.__clock = clock
         self.__state_time = None
+        self.__published_state = None
+        self.__history = collections.deque(maxlen=WattPilotModel.HISTORY_SIZE)
 
     def __update_state_time(self):
-        self.__state_time = datetime.now(tz=UTC)
+        self.__state_time = self.__clock.now()
+
+    def __publish_state(self):
+        # Internal transitions (e.g. update_power) do not change the state
+        state = self.models[0].state
+        if state != self.__published_state:
+            self.__published_state = state
+            timestamp = self.__clock.now().timestamp()
+            self.__history.append((timestamp, state))
+            status.update(state=state, state_timestamp=timestamp)
+
+    def get_state_history(self, start, end):
+        # Include the state active at the beginning of the range
+        first = max(bisect.bisect_right(self.__history, start, key=lambda x: x[0]) - 1, 0)
+        last = bisect.bisect_left(self.__history, end, key=lambda x: x[0])
+        return [self.__history[index] for index in range(first, last)]
 
     def get_time_in_state(self):
-        return datetime.now(tz=UTC) - self.__state_time
+        return self.__clock.now() - self.__state_time
 
 
 class WattPilotActor(pykka.ThreadingActor):
 
+    # Shared by all the actors, one thread serves every delayed call. Replaced by a VirtualClock to
+    # simulate time
+    clock = Clock()
+    # Shared by all the actors too, the responses come back as messages
+    http = HttpEngine()
+
     def __init__(self):
         super().__init__()
         self._proxy = self.actor_ref.proxy()
@@ -61,6 +92,10 @@ class WattPilotActor(pykka.ThreadingActor):
     def on_stop(self):
         self.do_cancel()
 
+    def ping(self):
+        # Returns once the messages received before have been handled
+        return True
+
     def get_actor(self, name):
         fsm = pykka.ActorRegistry.get_by_class_name(name)
         if fsm:
@@ -76,14 +111,13 @@ class WattPilotActor(pykka.ThreadingActor):
     def do_cancel(self):
         self.__do_cancel()
 
-    def do_delay(self, delay, method, *args, **kwargs):
+    def do_delay(self, delay, method, args=(), kwargs=None):
         assert isinstance(method, str)
         assert delay >= 0
         # Stop an already running timer
         self.__do_cancel()
         func = getattr(self._proxy, method)
         if delay > 0:
-            self.__timer = Timer(delay, func.defer, *args, **kwargs)
-            self.__timer.start()
+            self.__timer = self.clock.schedule(delay, func.defer, args, kwargs)
         else:
-            func.defer(*args, **kwargs)
+            func.defer(*args, **(kwargs or {}))
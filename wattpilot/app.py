@@ -15,14 +15,29 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from datetime import UTC, datetime
+import json
+from datetime import UTC, datetime, timedelta
+
+import flask
+from connexion import request
+
+from .actor import WattPilotActor
+from .status import status
 
 
 class WattPilotApp:
 
     wattpilot = None
+    fronius = None
     openweathermap = None
     temperature = None
+    # Only when the history is recorded
+    history = None
+
+    __status_cache = None, None
+
+    EVENTS_QUEUE = 100
+    EVENTS_KEEP_ALIVE = 15
 
     @staticmethod
     def get_current_state():
@@ -51,19 +66,155 @@ class WattPilotApp:
 
     @staticmethod
     def get_weather_forecast():
-        timestamp, cloudiness = WattPilotApp.openweathermap.get_forecast().get()
-        will_run = WattPilotApp.wattpilot.get_scheduled_by_weather().get()
+        # What WattPilot last decided on, read from the status snapshot like /status
+        _, snapshot = status.get()
+        timestamp = snapshot.get("forecast_timestamp")
+        cloudiness = snapshot.get("decision_cloudiness")
         return {
-            "timestamp": datetime.fromtimestamp(timestamp,tz=UTC),
-            "cloudiness": cloudiness,
-            "will_run": will_run
+            "timestamp": datetime.fromtimestamp(timestamp, tz=UTC) if timestamp is not None else None,
+            "cloudiness": None if cloudiness is None else round(cloudiness),
+            "will_run": snapshot.get("will_run"),
         }
 
     @staticmethod
     def get_loads():
         loads = WattPilotApp.wattpilot.get_active_loads().get()
-        return [{"pin": load.pin, "state": True} for load in loads]
+        return [{
+            "pin": load.pin,
+            "state": True,
+            "power": load.power,
+            "since": datetime.fromtimestamp(load.since, tz=UTC),
+            "energy": round(load.energy, 1)
+        } for load in loads]
 
     @staticmethod
     def get_temperature():
-        return {"temperature": round(WattPilotApp.temperature.get_temperature().get(), 1)}
+        sensors = WattPilotApp.temperature.get_temperatures().get()
+        return {
+            "temperature": round(WattPilotApp.temperature.get_temperature().get(), 1),
+            "sensors": {name: None if value is None else round(value, 1) for name, value in sensors.items()}
+        }
+
+    @staticmethod
+    def get_health():
+        power, timestamp, stale = WattPilotApp.fronius.get_reading().get()
+        upstreams = sorted(WattPilotActor.http.get_health().items())
+        return {
+            "upstreams": [{"host": host, **health} for host, health in upstreams],
+            "power": {
+                "power": power,
+                "timestamp": datetime.fromtimestamp(timestamp, tz=UTC) if timestamp is not None else None,
+                "stale": stale,
+            },
+        }
+
+    @staticmethod
+    def __render_status(snapshot):
+        def timestamp(key):
+            value = snapshot.get(key)
+            return datetime.fromtimestamp(value, tz=UTC) if value is not None else None
+
+        # What WattPilot decided on, not the next forecast slot
+        cloudiness = snapshot.get("decision_cloudiness")
+        return {
+            "state": snapshot.get("state"),
+            "trigger": snapshot.get("schedule_trigger", False),
+            "loads": [{"pin": pin, "state": True} for pin in snapshot.get("loads", ())],
+            "power": {
+                "power": snapshot.get("power"),
+                "timestamp": timestamp("power_timestamp"),
+            },
+            "temperature": {
+                "temperature": snapshot.get("temperature"),
+                "timestamp": timestamp("temperature_timestamp"),
+                "sensors": snapshot.get("temperatures", {}),
+            },
+            "weather": {
+                "cloudiness": None if cloudiness is None else round(cloudiness),
+                "will_run": snapshot.get("will_run"),
+                "timestamp": timestamp("forecast_timestamp"),
+            },
+        }
+
+    @staticmethod
+    def get_status():
+        # Served from the status snapshot, the actors are not involved at all
+        etag, snapshot = status.get()
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("If-None-Match") == etag:
+            return None, 304, headers
+        cached_etag, body = WattPilotApp.__status_cache
+        if cached_etag != etag:
+            body = WattPilotApp.__render_status(snapshot)
+            WattPilotApp.__status_cache = etag, body
+        return body, 200, headers
+
+    @staticmethod
+    def __stream_events(subscription):
+        try:
+            while True:
+                events = subscription.get(timeout=WattPilotApp.EVENTS_KEEP_ALIVE)
+                if not events:
+                    # Comment line, keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                for version, changes in events:
+                    yield f"id: {version}\nevent: status\ndata: {json.dumps(changes)}\n\n"
+        finally:
+            subscription.close()
+
+    @staticmethod
+    def get_events():
+        subscription = status.subscribe(WattPilotApp.EVENTS_QUEUE)
+        return flask.Response(WattPilotApp.__stream_events(subscription), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache"})
+
+    @staticmethod
+    def __parse_time(value):
+        # Without a timezone, the time is UTC
+        time = datetime.fromisoformat(value)
+        return time if time.tzinfo else time.replace(tzinfo=UTC)
+
+    @staticmethod
+    def __time_range(start, end):
+        end = WattPilotApp.__parse_time(end) if end else datetime.now(tz=UTC)
+        start = WattPilotApp.__parse_time(start) if start else end - timedelta(days=1)
+        if start >= end:
+            raise ValueError("Start must be before end")
+        return start.timestamp(), end.timestamp()
+
+    @staticmethod
+    def __get_history(actor, series, start, end, points):
+        try:
+            start, end = WattPilotApp.__time_range(start, end)
+        except ValueError:
+            return "Invalid time range", 400
+        # The actors only keep the last days in memory, the recorded history goes further back
+        oldest = actor.get_history_start().get() if WattPilotApp.history else None
+        if WattPilotApp.history and (oldest is None or start < oldest):
+            samples = WattPilotApp.history.get_history(series, start, end, points).get()
+        else:
+            samples = actor.get_history(start, end, points).get()
+        return [{
+            "timestamp": datetime.fromtimestamp(timestamp, tz=UTC),
+            "minimum": minimum,
+            "maximum": maximum,
+            "mean": mean,
+        } for timestamp, minimum, maximum, mean in samples]
+
+    @staticmethod
+    def get_power_history(start=None, end=None, points=200):
+        return WattPilotApp.__get_history(WattPilotApp.fronius, "power", start, end, points)
+
+    @staticmethod
+    def get_temperature_history(start=None, end=None, points=200):
+        return WattPilotApp.__get_history(WattPilotApp.temperature, "temperature", start, end, points)
+
+    @staticmethod
+    def get_state_history(start=None, end=None):
+        try:
+            start, end = WattPilotApp.__time_range(start, end)
+        except ValueError:
+            return "Invalid time range", 400
+        transitions = WattPilotApp.wattpilot.get_state_history(start, end).get()
+        return [{"timestamp": datetime.fromtimestamp(timestamp, tz=UTC), "state": state}
+                for timestamp, state in transitions]
@@ -0,0 +1,109 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import heapq
+import itertools
+import threading
+from datetime import UTC, datetime, timedelta
+
+import pykka
+from pykka.messages import ProxyCall
+
+from .scheduler import Scheduler, Timer
+
+# Same message as proxy().ping() without building a proxy each time
+PING = ProxyCall(attr_path=("ping",), args=(), kwargs={})
+
+
+class Clock(Scheduler):
+    # Wall clock time, the scheduler thread runs the delayed calls
+
+    def now(self):
+        return datetime.now(tz=UTC)
+
+
+class VirtualClock:
+    # Time only moves forward when told to. The delayed calls falling due run in order, the actors
+    # settle before the next deadline
+
+    def __init__(self, start):
+        assert start.tzinfo is not None
+        self.__now = start
+        self.__lock = threading.Lock()
+        self.__queue = []
+        self.__sequence = itertools.count()
+        self.__pending = 0
+
+    def now(self):
+        with self.__lock:
+            return self.__now
+
+    def schedule(self, delay, function, args=(), kwargs=None):
+        assert delay >= 0
+        with self.__lock:
+            deadline = self.__now + timedelta(seconds=delay)
+            timer = Timer(self, deadline, next(self.__sequence), function, args, kwargs or {})
+            heapq.heappush(self.__queue, timer)
+            self.__pending += 1
+            return timer
+
+    def cancel(self, timer):
+        with self.__lock:
+            if timer.active:
+                timer.active = False
+                self.__pending -= 1
+
+    def pending(self):
+        return self.__pending
+
+    def advance(self, seconds):
+        self.run_until(self.now() + timedelta(seconds=seconds))
+
+    def run_until(self, end):
+        while True:
+            self.settle()
+            with self.__lock:
+                while self.__queue and not self.__queue[0].active:
+                    heapq.heappop(self.__queue)
+                if not self.__queue or self.__queue[0].deadline > end:
+                    self.__now = max(self.__now, end)
+                    return
+                timer = heapq.heappop(self.__queue)
+                timer.active = False
+                self.__pending -= 1
+                self.__now = max(self.__now, timer.deadline)
+            timer.function(*timer.args, **timer.kwargs)
+
+    @staticmethod
+    def __delivered(refs):
+        # Inboxes are queues on which task_done() is never called, this counts every message put
+        return sum(ref.actor_inbox.unfinished_tasks for ref in refs)
+
+    @staticmethod
+    def settle():
+        # Handling a message may send new ones to other actors. Once a ping has been answered, the
+        # actor handled everything sent before. The actors are idle when the pings were the only
+        # messages delivered during a round.
+        while True:
+            refs = [ref for ref in pykka.ActorRegistry.get_all() if ref.is_alive()]
+            delivered = VirtualClock.__delivered(refs)
+            try:
+                pykka.get_all([ref.ask(PING, block=False) for ref in refs])
+            except pykka.ActorDeadError:
+                continue
+            if VirtualClock.__delivered(refs) == delivered + len(refs):
+                return
@@ -15,38 +15,58 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import concurrent.futures
 import logging
 import re
+import threading
 import time
 
 logger = logging.getLogger(__name__)
 
 
 class GpioDevice:
+    # Relays on GPIO outputs, active low. A shadow copy of the outputs serves the reads and skips the
+    # writes which would not change anything
 
     def __init__(self):
         import RPi.GPIO as GPIO
+        self.__gpio = GPIO
         GPIO.setwarnings(False)
         GPIO.setmode(GPIO.BCM)
+        self.__pins = {}
 
     def setup(self, pin):
-        import RPi.GPIO as GPIO
-        GPIO.setup(pin, GPIO.OUT)
-        self.set_pin(pin, False)
+        self.__gpio.setup(pin, self.__gpio.OUT, initial=self.__gpio.HIGH)
+        self.__pins[pin] = False
 
     def cleanup(self):
-        import RPi.GPIO as GPIO
-        GPIO.cleanup()
+        self.__gpio.cleanup()
+        self.__pins.clear()
+
+    def __output(self, values):
+        # A single call for all the pins, written in the given order
+        self.__gpio.output(list(values), [self.__gpio.LOW if value else self.__gpio.HIGH for value in values.values()])
+
+    def set_pins(self, values):
+        assert all(isinstance(pin, int) and isinstance(value, bool) for pin, value in values.items())
+        changes = {pin: value for pin, value in values.items() if self.__pins[pin] != value}
+        if changes:
+            self.__output(changes)
+            self.__pins.update(changes)
 
     def set_pin(self, pin, value):
-        import RPi.GPIO as GPIO
-        assert isinstance(pin, int)
-        assert isinstance(value, bool)
-        GPIO.output(pin, GPIO.LOW if value else GPIO.HIGH)
+        self.set_pins({pin: value})
 
     def get_pin(self, pin):
-        import RPi.GPIO as GPIO
-        return GPIO.input(pin) == GPIO.LOW
+        return self.__pins[pin]
+
+    def verify(self):
+        mismatches = {pin: value for pin, value in self.__pins.items()
+                      if (self.__gpio.input(pin) == self.__gpio.LOW) != value}
+        if mismatches:
+            logger.warning("Outputs do not match, writing them again: %s", mismatches)
+            self.__output(mismatches)
+        return not mismatches
 
 
 class TempSensorDevice:
@@ -54,6 +74,7 @@ class TempSensorDevice:
     CRE = re.compile(r" t=(-?\d+)$")
 
     def __init__(self, name, address, offset=0.0):
+        self.__name = name
         self.__address = address
         self.__path = f"/sys/bus/w1/devices/{address}/w1_slave"
         self.__offset = offset
@@ -83,5 +104,85 @@ class TempSensorDevice:
                         logger.debug(f"Bad CRC: {raw!s}")
                 time.sleep(0.1)
         except OSError:
-            logger.exception(f"Unable to read temperature ({self.name})")
+            logger.exception(f"Unable to read temperature ({self.__name})")
         return None
+
+
+class TempSensorGroup:
+    # Reads the sensors in parallel, each one with its own timeout. A sensor which fails or is too slow
+    # keeps its last good value, with the time it was read, for max_age seconds
+
+    @staticmethod
+    def from_config(config, device=TempSensorDevice):
+        sections = sorted(section for section in config.sections() if section.startswith("sensor_"))
+        timeout = config.getfloat("temperature", "timeout", fallback=2.0)
+        timeouts = {}
+        if sections:
+            sensors = {}
+            for section in sections:
+                name = section.removeprefix("sensor_")
+                sensors[name] = device(name, config.get(section, "address"),
+                                       config.getfloat(section, "offset", fallback=0.0))
+                timeouts[name] = config.getfloat(section, "timeout", fallback=timeout)
+        else:
+            sensors = {"boiler": device("boiler", config.get("temperature", "address"))}
+        return TempSensorGroup(sensors, timeout=timeout, max_age=config.getint("temperature", "max_age", fallback=300),
+                               timeouts=timeouts)
+
+    def __init__(self, sensors, timeout=2.0, max_age=300, timeouts=None, clock=time.time):
+        self.__sensors = sensors
+        self.__timeouts = {name: (timeouts or {}).get(name, timeout) for name in sensors}
+        self.__max_age = max_age
+        self.__clock = clock
+        # One thread per sensor and one waiting for a round to complete
+        self.__executor = concurrent.futures.ThreadPoolExecutor(len(sensors) + 1, thread_name_prefix="sensor")
+        self.__lock = threading.Lock()
+        self.__pending = {}
+        self.__last = {}
+
+    @property
+    def names(self):
+        return list(self.__sensors)
+
+    def close(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def read(self, callback):
+        # callback gets (value, timestamp) by sensor, (None, None) if unknown
+        with self.__lock:
+            for name, sensor in self.__sensors.items():
+                if name not in self.__pending:
+                    self.__pending[name] = self.__executor.submit(self.__read, sensor)
+            pending = dict(self.__pending)
+        self.__executor.submit(self.__collect, pending, callback)
+
+    def __read(self, sensor):
+        return sensor.value(), self.__clock()
+
+    def __collect(self, pending, callback):
+        # Every timeout counts from the start of the round
+        start = time.monotonic()
+        late = set()
+        for name, future in sorted(pending.items(), key=lambda item: self.__timeouts[item[0]]):
+            remaining = self.__timeouts[name] - (time.monotonic() - start)
+            if not concurrent.futures.wait([future], timeout=max(remaining, 0)).done:
+                late.add(name)
+        now = self.__clock()
+        readings = {}
+        with self.__lock:
+            for name, future in pending.items():
+                if name in late:
+                    logger.warning("Sensor %s did not answer within %.1fs", name, self.__timeouts[name])
+                elif future.done():
+                    # Rounds overlap when a read outlasts the timeout, only the first one collects it
+                    if self.__pending.get(name) is future:
+                        del self.__pending[name]
+                    if future.exception():
+                        logger.error("Unable to read sensor %s: %s", name, future.exception())
+                    elif future.result()[0] is not None:
+                        self.__last[name] = future.result()
+                value, timestamp = self.__last.get(name, (None, None))
+                if timestamp is None or now - timestamp > self.__max_age:
+                    value, timestamp = None, None
+                readings[name] = value, timestamp
+        callback(readings)
@@ -0,0 +1,220 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import collections
+import dataclasses
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Response:
+    status: int
+    # Lower case names
+    headers: dict
+    body: bytes
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.last = 0.0
+        self.maximum = 0.0
+        self.total = 0.0
+
+    def add(self, duration):
+        self.requests += 1
+        self.last = duration
+        self.maximum = max(self.maximum, duration)
+        self.total += duration
+
+    @property
+    def average(self):
+        return self.total / self.requests if self.requests else 0.0
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "last": self.last,
+            "average": self.average,
+            "maximum": self.maximum,
+        }
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    # Opens after threshold consecutive failures, a single request goes through once the jittered
+    # backoff elapsed. If it fails, the circuit opens again for twice as long
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=3, backoff=10, maximum=600, clock=time.monotonic):
+        self.__threshold = threshold
+        self.__backoff = backoff
+        self.__maximum = maximum
+        self.__clock = clock
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.__opened = 0
+        self.__retry_at = 0
+
+    def allow(self):
+        if self.state == CircuitBreaker.CLOSED:
+            return True
+        if self.state == CircuitBreaker.OPEN and self.__clock() >= self.__retry_at:
+            self.state = CircuitBreaker.HALF_OPEN
+            return True
+        # Open, or the half-open request is still pending
+        return False
+
+    def success(self):
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.__opened = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.__threshold:
+            backoff = min(self.__backoff * 2 ** self.__opened, self.__maximum)
+            self.__retry_at = self.__clock() + random.uniform(backoff / 2, backoff)
+            self.__opened += 1
+            self.state = CircuitBreaker.OPEN
+
+    def get_retry_in(self):
+        return max(self.__retry_at - self.__clock(), 0) if self.state == CircuitBreaker.OPEN else 0
+
+    def as_dict(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_in": self.get_retry_in(),
+        }
+
+
+class HttpEngine:
+    # Asyncio loop in its own thread shared by all the actors, the callback gets the response or the
+    # error. A GET failing on the transport is retried, timeouts are not
+
+    def __init__(self, timeout=10, retries=1, breaker=None):
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__breakers = collections.defaultdict(lambda: CircuitBreaker(**(breaker or {})))
+        self.__lock = threading.Lock()
+        self.__loop = None
+        self.__thread = None
+        self.__client = None
+        self.__stats = collections.defaultdict(RequestStats)
+
+    def __start(self):
+        # Started on the first request
+        with self.__lock:
+            if self.__loop is None:
+                self.__loop = asyncio.new_event_loop()
+                self.__client = httpx.AsyncClient(timeout=self.__timeout)
+                self.__thread = threading.Thread(target=self.__loop.run_forever, name="HttpEngine", daemon=True)
+                self.__thread.start()
+            return self.__loop
+
+    def stop(self):
+        with self.__lock:
+            if self.__loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.__client.aclose(), self.__loop).result()
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join()
+            self.__loop.close()
+            self.__loop = None
+
+    def request(self, callback, url, method="GET", headers=None, data=None, timeout=None):
+        # callback(response, error), exactly one of them is None. Non 2xx statuses are responses too
+        coroutine = self.__request(callback, method, url, headers, data, timeout or self.__timeout)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__start())
+
+    async def __send(self, method, url, headers, data, timeout):
+        retries = self.__retries if method == "GET" else 0
+        while True:
+            try:
+                return await self.__client.request(method, url, headers=headers, content=data, timeout=timeout)
+            except httpx.TimeoutException as exception:
+                raise TimeoutError(f"Timeout after {timeout}s") from exception
+            except httpx.TransportError as exception:
+                if retries == 0:
+                    raise ConnectionError(str(exception) or type(exception).__name__) from exception
+                retries -= 1
+                logger.debug("Request to %s failed, retrying: %s", url, exception)
+
+    async def __request(self, callback, method, url, headers, data, timeout):
+        host = urllib.parse.urlsplit(url).netloc
+        stats = self.__stats[host]
+        breaker = self.__breakers[host]
+        start = time.monotonic()
+        response = error = None
+        if not breaker.allow():
+            error = CircuitOpenError(f"Circuit to {host} open, retrying in {breaker.get_retry_in():.0f}s")
+        else:
+            try:
+                reply = await self.__send(method, url, headers, data, timeout)
+                response = Response(reply.status_code, dict(reply.headers), reply.content)
+                stats.add(time.monotonic() - start)
+            except Exception as exception:
+                # Whatever else httpx raises (e.g. an undecodable body) is an error for the caller too
+                stats.failures += 1
+                error = exception
+            finally:
+                # Exactly once per request, a half-open circuit waits for this result
+                self.__update_breaker(host, breaker, response is not None and response.status < 500)
+        try:
+            callback(response, error)
+        except Exception:
+            # E.g. the actor has been stopped in the meantime
+            logger.exception("Unable to deliver the response from %s", url)
+
+    @staticmethod
+    def __update_breaker(host, breaker, success):
+        state = breaker.state
+        if success:
+            breaker.success()
+        else:
+            breaker.failure()
+        if breaker.state != state:
+            if breaker.state == CircuitBreaker.OPEN:
+                logger.warning("Circuit to %s open, retrying in %.0fs", host, breaker.get_retry_in())
+            elif breaker.state == CircuitBreaker.CLOSED:
+                logger.info("Circuit to %s closed", host)
+
+    def get_health(self):
+        # Read from other threads, a copy of the dict is enough
+        return {host: breaker.as_dict() for host, breaker in self.__breakers.copy().items()}
+
+    def get_stats(self, host):
+        return self.__stats[host].as_dict()
@@ -18,28 +18,65 @@
 import collections
 import json
 import logging
+import re
 import statistics
-import urllib.request
+from typing import Final
 
 from .actor import WattPilotActor
+from .engine import CircuitOpenError
+from .series import RingBuffer, downsample
+from .status import status
+
+
+class FieldParser:
+    # Picks a few numeric fields out of the raw JSON without parsing all of it
+
+    def __init__(self, *fields):
+        self.__fields = tuple(field.encode("ascii") for field in fields)
+        names = b"|".join(self.__fields)
+        self.__cre = re.compile(rb'"(' + names + rb')"\s*:\s*(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)')
+
+    def parse(self, raw):
+        # Returns None if a field is missing or repeated (e.g. several meters)
+        values = {}
+        for match in self.__cre.finditer(raw):
+            key, value = match.groups()
+            if key in values:
+                return None
+            values[key] = value
+        if len(values) != len(self.__fields):
+            return None
+        return tuple(float(values[key]) for key in self.__fields)
+
+
+def to_bytes(raw):
+    return raw.encode("ascii") if isinstance(raw, str) else raw
 
 
 class EnergyReading:
 
-    def __init__(self, document):
-        self.__node = document["Body"]["Data"]["0"]
+    __slots__ = ("consumed", "produced", "timestamp")
 
-    @property
-    def timestamp(self):
-        return self.__node["TimeStamp"]
+    PARSER = FieldParser("TimeStamp", "EnergyReal_WAC_Sum_Consumed", "EnergyReal_WAC_Sum_Produced")
 
-    @property
-    def consumed(self):
-        return self.__node["EnergyReal_WAC_Sum_Consumed"]
+    def __init__(self, timestamp, consumed, produced):
+        self.timestamp = timestamp
+        self.consumed = consumed
+        self.produced = produced
+
+    @staticmethod
+    def from_document(document):
+        node = document["Body"]["Data"]["0"]
+        return EnergyReading(
+            node["TimeStamp"], node["EnergyReal_WAC_Sum_Consumed"], node["EnergyReal_WAC_Sum_Produced"])
 
-    @property
-    def produced(self):
-        return self.__node["EnergyReal_WAC_Sum_Produced"]
+    @staticmethod
+    def parse(raw):
+        raw = to_bytes(raw)
+        values = EnergyReading.PARSER.parse(raw)
+        if values is not None:
+            return EnergyReading(*values)
+        return EnergyReading.from_document(json.loads(raw))
 
 
 class AverageReadings:
@@ -57,23 +94,15 @@ class AverageReadings:
         return statistics.mean(self.__queue) if self.__queue else 0
 
 
-class Fronius(WattPilotActor):
+class EnergyPower:
+    # Difference of two consecutive energy counter readings
 
-    def __init__(self, config):
-        super().__init__()
+    PATH = "/solar_api/v1/GetMeterRealtimeData.cgi?Scope=System"
+    AVERAGE = 2
 
+    def __init__(self):
         self.logger = logging.getLogger(__name__)
-
-        self.__host = config.get("main", "fronius_host")
-        self.__url = f"http://{self.__host}/solar_api/v1/GetMeterRealtimeData.cgi?Scope=System"
-
-        self.__callback = None
         self.__last_reading = None
-        self.__power = AverageReadings(maxlen=2)
-
-    def download(self):
-        with urllib.request.urlopen(self.__url, timeout=5) as f:
-            return f.read().decode("ascii")
 
     @staticmethod
     def compute_power(reading1, reading2):
@@ -85,36 +114,148 @@ class Fronius(WattPilotActor):
         produced = reading2.produced - reading1.produced
         return (consumed - produced) * 3600 / duration
 
+    def clear(self):
+        self.__last_reading = None
+
+    def update(self, raw):
+        reading = EnergyReading.parse(raw)
+        self.logger.debug("Consumed: %dWh Produced: %dWh", reading.consumed, reading.produced)
+        power = self.compute_power(self.__last_reading, reading) if self.__last_reading else None
+        self.__last_reading = reading
+        return power
+
+
+class MeterPower:
+    # Instantaneous power measured by the smart meter
+
+    PATH = "/solar_api/v1/GetMeterRealtimeData.cgi?Scope=System"
+    AVERAGE = 1
+    PARSER = FieldParser("PowerReal_P_Sum")
+
+    def clear(self):
+        pass
+
+    def update(self, raw):
+        raw = to_bytes(raw)
+        values = MeterPower.PARSER.parse(raw)
+        if values is not None:
+            return values[0]
+        return json.loads(raw)["Body"]["Data"]["0"]["PowerReal_P_Sum"]
+
+
+class PowerFlowPower:
+    # Instantaneous grid power reported by the inverter power flow
+
+    PATH = "/solar_api/v1/GetPowerFlowRealtimeData.fcgi"
+    AVERAGE = 1
+
+    def clear(self):
+        pass
+
+    def update(self, raw):
+        # P_Grid is null when there is no meter or the inverter is starting up
+        return json.loads(raw)["Body"]["Data"]["Site"]["P_Grid"]
+
+
+class Fronius(WattPilotActor):
+
+    POWER_SOURCES: Final = {
+        "energy": EnergyPower,
+        "meter": MeterPower,
+        "powerflow": PowerFlowPower,
+    }
+
+    # Four days of samples at the fastest polling rate
+    HISTORY_SIZE = 4 * 24 * 120
+
+    def __init__(self, config):
+        super().__init__()
+
+        self.logger = logging.getLogger(__name__)
+
+        self.__host = config.get("main", "fronius_host")
+
+        source = config.get("main", "fronius_power_source", fallback="energy")
+        if source not in Fronius.POWER_SOURCES:
+            raise ValueError(f"Unknown power source: {source}")
+        self.__source = Fronius.POWER_SOURCES[source]()
+        self.__url = f"http://{self.__host}{self.__source.PATH}"
+
+        self.__callback = None
+        self.__last = None
+        self.__max_age = config.getint("main", "power_max_age", fallback=180)
+        self.__power = AverageReadings(maxlen=self.__source.AVERAGE)
+        self.__history = RingBuffer(Fronius.HISTORY_SIZE)
+
+    def download(self):
+        # The response comes back to update()
+        self.http.request(self._proxy.update.defer, self.__url, timeout=5)
+
     def register_callback(self, callback):
         self.logger.info("Register callback: %s", callback)
         self.__callback = callback
 
     def run(self, delay=30):
-        self.__last_reading = None
+        self.__source.clear()
         self.__power.clear()
         self.run_internal(delay)
 
     def run_internal(self, delay):
         try:
-            reading = EnergyReading(json.loads(self.download()))
-            self.logger.debug("Consumed: %dWh Produced: %dWh", reading.consumed, reading.produced)
-            if self.__last_reading:
-                power = self.compute_power(self.__last_reading, reading)
-                self.logger.info("Power: %.2fW", power)
-                self.__power.append(power)
-                if self.__callback:
-                    self.__callback.defer()
-            self.__last_reading = reading
-        except TimeoutError:
-            self.logger.error("Timeout connecting to %s", self.__host)
-        except urllib.error.URLError as exception:
-            self.logger.error("Unable to download data: %s", str(exception.reason))
+            self.download()
         finally:
             self.do_delay(delay, "run_internal", args=[delay])
 
+    def update(self, response, error):
+        try:
+            if error is not None:
+                raise error
+            if response.status != 200:
+                raise ConnectionError(f"HTTP {response.status}")
+            self.__update_power(self.__source.update(response.body))
+            return
+        except CircuitOpenError as exception:
+            self.logger.debug(str(exception))
+        except TimeoutError:
+            self.logger.error("Timeout connecting to %s", self.__host)
+        except OSError as exception:
+            self.logger.error("Unable to download data: %s", str(exception))
+        except (ValueError, KeyError, TypeError) as exception:
+            self.logger.error("Unable to parse data: %s", str(exception))
+        # The last reading again, its timestamp tells the callback how old it is
+        if self.__callback and self.__last is not None:
+            self.__callback.defer(*self.__last, repeated=True)
+
+    def __update_power(self, power):
+        if power is not None:
+            self.logger.info("Power: %.2fW", power)
+            self.__power.append(power)
+            timestamp = self.clock.now().timestamp()
+            self.__history.append(timestamp, power)
+            status.update(power=self.__power.average(), power_timestamp=timestamp)
+            self.__last = self.__power.average(), timestamp
+            if self.__callback:
+                self.__callback.defer(self.__power.average(), timestamp)
+
     def get_power(self):
         return self.__power.average()
 
+    def get_reading(self):
+        # Last known power, stale when older than the maximum age
+        if self.__last is None:
+            return None, None, True
+        power, timestamp = self.__last
+        return power, timestamp, self.clock.now().timestamp() - timestamp > self.__max_age
+
+    def get_history(self, start, end, points):
+        return downsample(*self.__history.range(start, end), start, end, points)
+
+    def get_history_start(self):
+        return self.__history.first
+
+    def get_stats(self):
+        return self.http.get_stats(self.__host)
+
 
 if __name__ == "__main__":
     import configparser
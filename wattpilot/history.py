@@ -0,0 +1,173 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import logging
+import sqlite3
+from typing import Final
+
+from .actor import WattPilotActor
+from .series import downsample, merge
+from .status import status
+
+
+class TimeSeriesStore:
+    # Samples in SQLite, the numeric ones are also aggregated into hourly rollups kept much longer
+
+    SERIES: Final = {
+        "power": 1,
+        "temperature": 2,
+        "state": 3,
+    }
+    NUMERIC: Final = {"power", "temperature"}
+    ROLLUP_PERIOD = 3600
+
+    def __init__(self, path):
+        self.__connection = sqlite3.connect(path)
+        # Appends go to the write-ahead log, fewer writes and no fsync on every commit
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        with self.__connection:
+            self.__connection.execute("""
+                CREATE TABLE IF NOT EXISTS samples (
+                    series INTEGER NOT NULL,
+                    timestamp REAL NOT NULL,
+                    value NOT NULL
+                )""")
+            self.__connection.execute("""
+                CREATE INDEX IF NOT EXISTS samples_series_timestamp ON samples (series, timestamp)""")
+            self.__connection.execute("""
+                CREATE TABLE IF NOT EXISTS rollups (
+                    series INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    minimum REAL NOT NULL,
+                    maximum REAL NOT NULL,
+                    total REAL NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (series, bucket)
+                ) WITHOUT ROWID""")
+
+    def close(self):
+        self.__connection.close()
+
+    def append(self, samples):
+        # samples: iterable of (series, timestamp, value)
+        rows = []
+        rollups = []
+        for series, timestamp, value in samples:
+            rows.append((self.SERIES[series], timestamp, value))
+            if series in self.NUMERIC:
+                bucket = int(timestamp // self.ROLLUP_PERIOD) * self.ROLLUP_PERIOD
+                rollups.append((self.SERIES[series], bucket, value))
+        with self.__connection:
+            self.__connection.executemany("INSERT INTO samples VALUES (?, ?, ?)", rows)
+            self.__connection.executemany("""
+                INSERT INTO rollups VALUES (?1, ?2, ?3, ?3, ?3, 1)
+                ON CONFLICT (series, bucket) DO UPDATE SET
+                    minimum = min(minimum, excluded.minimum),
+                    maximum = max(maximum, excluded.maximum),
+                    total = total + excluded.total,
+                    count = count + 1""", rollups)
+
+    def prune(self, samples_before, rollups_before):
+        with self.__connection:
+            self.__connection.execute("DELETE FROM samples WHERE timestamp < ?", (samples_before,))
+            self.__connection.execute("DELETE FROM rollups WHERE bucket < ?", (rollups_before,))
+
+    def get_samples(self, series, start, end):
+        cursor = self.__connection.execute(
+            "SELECT timestamp, value FROM samples WHERE series = ? AND timestamp >= ? AND timestamp < ? "
+            "ORDER BY timestamp", (self.SERIES[series], start, end))
+        return cursor.fetchall()
+
+    def get_rollups(self, series, start, end):
+        cursor = self.__connection.execute(
+            "SELECT bucket, minimum, maximum, total / count, count FROM rollups "
+            "WHERE series = ? AND bucket >= ? AND bucket < ? ORDER BY bucket",
+            (self.SERIES[series], start, end))
+        return cursor.fetchall()
+
+
+class History(WattPilotActor):
+    # Writes the status changes in batches, the actors never wait for the disk
+
+    def __init__(self, config):
+        super().__init__()
+        self.logger = logging.getLogger(__name__)
+        self.__path = config.get("history", "path")
+        self.__retention = config.getint("history", "retention", fallback=7) * 86400
+        self.__rollup_retention = config.getint("history", "rollup_retention", fallback=730) * 86400
+        self.__store = None
+        self.__subscription = status.subscribe(maxlen=10000)
+        self.__values = {}
+        self.__pruned = 0
+
+    def on_start(self):
+        # SQLite connections are bound to the thread which created them
+        self.__store = TimeSeriesStore(self.__path)
+
+    def on_stop(self):
+        super().on_stop()
+        self.flush()
+        self.__subscription.close()
+        self.__store.close()
+
+    def __collect(self):
+        samples = []
+        for _, changes in self.__subscription.get(timeout=0):
+            self.__values.update(changes)
+            for series in ("power", "temperature", "state"):
+                if f"{series}_timestamp" in changes and series in self.__values:
+                    samples.append((series, changes[f"{series}_timestamp"], self.__values[series]))
+        return samples
+
+    def flush(self):
+        samples = self.__collect()
+        if samples:
+            self.logger.debug("Writing %d samples", len(samples))
+            self.__store.append(samples)
+
+    def run(self, delay=300):
+        self.run_internal(delay)
+
+    def run_internal(self, delay):
+        try:
+            self.flush()
+            now = self.clock.now().timestamp()
+            if now - self.__pruned > 86400:
+                self.__store.prune(now - self.__retention, now - self.__rollup_retention)
+                self.__pruned = now
+        except sqlite3.Error:
+            self.logger.exception("Unable to write the history")
+        finally:
+            self.do_delay(delay, "run_internal", args=[delay])
+
+    def get_samples(self, series, start, end):
+        self.flush()
+        return self.__store.get_samples(series, start, end)
+
+    def get_rollups(self, series, start, end):
+        self.flush()
+        return self.__store.get_rollups(series, start, end)
+
+    def get_history(self, series, start, end, points):
+        # Same buckets as the actors, from the raw samples while they are kept, the rollups before
+        self.flush()
+        if start >= self.clock.now().timestamp() - self.__retention:
+            samples = self.__store.get_samples(series, start, end)
+            return downsample([timestamp for timestamp, _ in samples], [value for _, value in samples],
+                              start, end, points)
+        return merge(self.__store.get_rollups(series, start, end), start, end, points)
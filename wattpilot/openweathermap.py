@@ -15,15 +15,91 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import bisect
+import hashlib
 import json
 import logging
-import urllib
+import os
+from array import array
 from datetime import UTC, datetime
 
 from .actor import WattPilotActor
+from .status import status
+
+
+class Forecast:
+    # Slots as parallel arrays, a slot holds until the next one. The cloudiness and the clear sky fraction
+    # are integrated over time, a window aggregate is two bisections
+
+    PERIOD = 3 * 3600
+
+    def __init__(self, timestamps=(), clouds=(), temperatures=()):
+        assert len(timestamps) == len(clouds) == len(temperatures)
+        self.timestamps = array("d", timestamps)
+        self.clouds = array("d", clouds)
+        self.temperatures = array("d", temperatures)
+        self.__values = {"clouds": self.clouds, "sky": array("d", map(Forecast.clear_sky, self.clouds))}
+        self.__integrals = {}
+        ends = self.timestamps[1:] + array("d", [self.timestamps[-1] + Forecast.PERIOD] if self else [])
+        for name, values in self.__values.items():
+            integral = self.__integrals[name] = array("d", [0])
+            for start, end, value in zip(self.timestamps, ends, values, strict=True):
+                integral.append(integral[-1] + value * (end - start))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @staticmethod
+    def from_document(document):
+        slots = document["list"]
+        return Forecast([slot["dt"] for slot in slots],
+                        [slot["clouds"]["all"] for slot in slots],
+                        [slot["main"]["temp"] - 273.15 for slot in slots])
+
+    def as_dict(self):
+        return {
+            "timestamps": self.timestamps.tolist(),
+            "clouds": self.clouds.tolist(),
+            "temperatures": self.temperatures.tolist(),
+        }
+
+    @staticmethod
+    def clear_sky(cloudiness):
+        # Fraction of the clear sky irradiance reaching the ground (Kasten & Czeplak)
+        return 1 - 0.75 * (cloudiness / 100) ** 3.4
+
+    def next(self, now):
+        # First slot starting after now
+        i = bisect.bisect_right(self.timestamps, now)
+        if i < len(self.timestamps):
+            return int(self.timestamps[i]), int(self.clouds[i])
+        return 0, 100
+
+    def __integrate(self, name, until):
+        # Within the forecast, from its first slot until the given time
+        i = bisect.bisect_right(self.timestamps, until) - 1
+        return self.__integrals[name][i] + self.__values[name][i] * (until - self.timestamps[i])
+
+    def __mean(self, name, start, end):
+        # None when the forecast does not cover any part of the window
+        if not self.timestamps:
+            return None
+        start = max(start, self.timestamps[0])
+        end = min(end, self.timestamps[-1] + Forecast.PERIOD)
+        if start >= end:
+            return None
+        return (self.__integrate(name, end) - self.__integrate(name, start)) / (end - start)
+
+    def cloudiness(self, start, end):
+        return self.__mean("clouds", start, end)
+
+    def irradiance(self, start, end):
+        # Mean fraction of the clear sky irradiance
+        return self.__mean("sky", start, end)
 
 
 class OpenWeatherMap(WattPilotActor):
+    # The forecast is cached on disk with its validators, the refreshes are conditional requests
 
     def __init__(self, config):
         super().__init__()
@@ -34,42 +110,126 @@ class OpenWeatherMap(WattPilotActor):
         lon = config.get("openweathermap", "lon")
         key = config.get("openweathermap", "key")
 
-        host = "api.openweathermap.org"
-        self.__url = f"https://{host}/data/2.5/forecast?lat={lat}&lon={lon}&appid={key}"
-        self.__cloud = 0, 100
+        self.__host = "api.openweathermap.org"
+        self.__url = f"https://{self.__host}/data/2.5/forecast?lat={lat}&lon={lon}&appid={key}"
+        self.__cache = config.get("openweathermap", "cache", fallback=None)
+        self.__forecast = Forecast()
+        self.__digest = None
+        self.__validators = {}
+        self.__fetched = 0
+
+    def on_start(self):
+        if self.__cache:
+            self.__load()
+
+    def __load(self):
+        try:
+            with open(self.__cache) as f:
+                cache = json.load(f)
+            self.__fetched = cache["fetched"]
+            self.__validators = cache["validators"]
+            self.__digest = cache["digest"]
+            self.__forecast = Forecast(**cache["forecast"])
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError, AssertionError) as exception:
+            self.logger.warning("Unable to load the forecast cache: %s", str(exception))
+            return
+        self.logger.info("Forecast fetched at %s loaded from %s",
+                         datetime.fromtimestamp(self.__fetched, tz=UTC), self.__cache)
+        self.__publish()
+
+    def __save(self):
+        if not self.__cache:
+            return
+        cache = {
+            "fetched": self.__fetched,
+            "validators": self.__validators,
+            "digest": self.__digest,
+            "forecast": self.__forecast.as_dict(),
+        }
+        # Never leave a partially written cache behind
+        temporary = f"{self.__cache}.tmp"
+        try:
+            with open(temporary, "w") as f:
+                json.dump(cache, f)
+            os.replace(temporary, self.__cache)
+        except OSError as exception:
+            self.logger.warning("Unable to save the forecast cache: %s", str(exception))
 
     def download(self):
-        with urllib.request.urlopen(self.__url, timeout=10) as f:
-            return f.read().decode("utf-8")
+        # Conditional request, the response comes back to update()
+        headers = {}
+        if "etag" in self.__validators:
+            headers["If-None-Match"] = self.__validators["etag"]
+        if "last-modified" in self.__validators:
+            headers["If-Modified-Since"] = self.__validators["last-modified"]
+        self.http.request(self._proxy.update.defer, self.__url, headers=headers)
 
-    @staticmethod
-    def __get_cloudiness(document):
-        now = datetime.now(tz=UTC).timestamp()
-        for forecast in document["list"]:
-            timestamp = forecast["dt"]
-            if timestamp > now:
-                return timestamp, forecast["clouds"]["all"]
-        return 0, 100
+    def __publish(self):
+        timestamp, cloudiness = self.get_forecast()
+        readable_time = datetime.fromtimestamp(timestamp, tz=UTC)
+        self.logger.info("Forecast. Timestamp: %s Cloud: %d%%", readable_time, cloudiness)
+        status.update(cloudiness=cloudiness, forecast_timestamp=timestamp)
 
     def run(self, delay=3600):
-        self.run_internal(delay)
+        # A forecast from the cache is fresh enough until the next refresh
+        age = self.clock.now().timestamp() - self.__fetched
+        if self.__forecast and 0 <= age < delay:
+            self.do_delay(delay - age, "run_internal", args=[delay])
+        else:
+            self.run_internal(delay)
 
     def run_internal(self, delay):
         try:
-            document = json.loads(self.download())
-            self.__cloud = self.__get_cloudiness(document)
-            timestamp, cloudiness = self.__cloud
-            readable_time = datetime.fromtimestamp(timestamp, tz=UTC)
-            self.logger.info("Forecast. Timestamp: %s Cloud: %d%%", readable_time, cloudiness)
-        except TimeoutError:
-            self.logger.error("Timeout connecting to %s", self.__host)
-        except urllib.error.URLError as exception:
-            self.logger.error("Unable to download data: %s", str(exception.reason))
+            self.download()
         finally:
             self.do_delay(delay, "run_internal", args=[delay])
 
+    def update(self, response, error):
+        if isinstance(error, TimeoutError):
+            self.logger.error("Timeout connecting to %s", self.__host)
+            return
+        if error is not None:
+            self.logger.error("Unable to download data: %s", str(error))
+            return
+        if response.status == 304:
+            self.logger.info("Forecast not modified")
+        elif response.status != 200:
+            self.logger.error("Unable to download data: HTTP %d", response.status)
+            return
+        else:
+            try:
+                self.__set_forecast(response)
+            except (ValueError, KeyError, TypeError) as exception:
+                self.logger.error("Unable to parse data: %s", str(exception))
+                return
+        self.__fetched = self.clock.now().timestamp()
+        self.__save()
+        if self.__forecast:
+            self.__publish()
+
+    def __set_forecast(self, response):
+        # An unchanged forecast is not parsed again
+        digest = hashlib.sha256(response.body).hexdigest()
+        if digest == self.__digest:
+            self.logger.info("Forecast unchanged")
+        else:
+            self.__forecast = Forecast.from_document(json.loads(response.body))
+            self.__digest = digest
+        self.__validators = {name: response.headers[name] for name in ("etag", "last-modified")
+                             if name in response.headers}
+
     def get_forecast(self):
-        return self.__cloud
+        return self.__forecast.next(self.clock.now().timestamp())
+
+    def get_cloudiness(self, start=None, end=None):
+        # Mean over the window when given and covered by the forecast, the next slot otherwise
+        if start is not None:
+            cloudiness = self.__forecast.cloudiness(start, end)
+            if cloudiness is not None:
+                return cloudiness
+        return self.get_forecast()[1]
 
-    def get_cloudiness(self):
-        return self.__cloud[1]
+    def get_irradiance(self, start, end):
+        return self.__forecast.irradiance(start, end)
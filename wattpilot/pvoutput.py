@@ -15,14 +15,78 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import collections
+import functools
 import logging
-import urllib
+import os
+import urllib.parse
 from datetime import UTC, datetime
 
 from .actor import WattPilotActor
 
 
+class Spool:
+    # Statuses waiting to be uploaded, one "timestamp value" per line. Appended to, only rewritten when
+    # the uploaded ones are removed
+
+    def __init__(self, path, maxlen):
+        self.logger = logging.getLogger(__name__)
+        self.__path = path
+        self.__statuses = collections.deque(maxlen=maxlen)
+        if path:
+            self.__load()
+
+    def __load(self):
+        try:
+            with open(self.__path) as f:
+                for line in f:
+                    timestamp, value = line.split()
+                    self.__statuses.append((float(timestamp), float(value)))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as exception:
+            self.logger.warning("Unable to load the spool: %s", str(exception))
+        if self.__statuses:
+            self.logger.info("%d statuses loaded from %s", len(self.__statuses), self.__path)
+
+    def __len__(self):
+        return len(self.__statuses)
+
+    def append(self, timestamp, value):
+        self.__statuses.append((timestamp, value))
+        if self.__path:
+            try:
+                with open(self.__path, "a") as f:
+                    f.write(f"{timestamp} {value}\n")
+            except OSError as exception:
+                self.logger.warning("Unable to write the spool: %s", str(exception))
+
+    def peek(self, count):
+        return [self.__statuses[i] for i in range(min(count, len(self.__statuses)))]
+
+    def remove(self, count):
+        for _ in range(min(count, len(self.__statuses))):
+            self.__statuses.popleft()
+        if self.__path:
+            temporary = f"{self.__path}.tmp"
+            try:
+                with open(temporary, "w") as f:
+                    f.writelines(f"{timestamp} {value}\n" for timestamp, value in self.__statuses)
+                os.replace(temporary, self.__path)
+            except OSError as exception:
+                self.logger.warning("Unable to write the spool: %s", str(exception))
+
+
 class PVOutput(WattPilotActor):
+    # Spools a status every run, uploads the spool in batches and retries a failed upload with a backoff
+
+    URL = "https://pvoutput.org/service/r2/addbatchstatus.jsp"
+    BATCH_SIZE = 30
+    # Stay well below the 60 requests per hour
+    MAX_BATCHES = 10
+    MAX_BACKOFF = 3600
+    # Older statuses are rejected by PVOutput
+    MAX_AGE = 14 * 86400
 
     def __init__(self, config, temperature):
         super().__init__()
@@ -30,23 +94,81 @@ class PVOutput(WattPilotActor):
 
         self.__temperature = temperature
 
-        key = config.get("pvoutput", "key")
-        sid = config.get("pvoutput", "sid")
+        self.__key = config.get("pvoutput", "key")
+        self.__sid = config.get("pvoutput", "sid")
+        # Extended fields follow the 6 standard ones: date, time, v1...v12
         field = config.get("pvoutput", "field")
+        self.__column = int(field.removeprefix("v")) + 1
+        self.__upload_interval = config.getint("pvoutput", "upload_interval", fallback=3600)
+        spool = config.get("pvoutput", "spool", fallback=None)
+        self.__spool = Spool(spool, maxlen=PVOutput.MAX_AGE // 300)
+        self.__next_upload = 0
+        self.__failures = 0
+        self.__uploading = False
+        self.__batches = 0
+        self.__delay = 300
+
+    def __format(self, timestamp, value):
+        time = datetime.fromtimestamp(timestamp, tz=UTC)
+        columns = [time.strftime("%Y%m%d"), time.strftime("%H:%M")] + [""] * (self.__column - 1)
+        columns[self.__column] = f"{value:g}"
+        return ",".join(columns)
 
-        base_url = "https://pvoutput.org/service/r2/addstatus.jsp"
-        self.__url = f"{base_url}?key={key}&sid={sid}&d={{date}}&t={{time}}&{field}={{temperature}}"
+    def send_statuses(self, statuses):
+        # The response comes back to update()
+        data = ";".join(self.__format(timestamp, value) for timestamp, value in statuses)
+        self.logger.debug("Sending %s", data)
+        headers = {
+            "X-Pvoutput-Apikey": self.__key,
+            "X-Pvoutput-SystemId": self.__sid,
+            "Content-Type": "application/x-www-form-urlencoded",
+        }
+        self.http.request(functools.partial(self._proxy.update.defer, len(statuses)), PVOutput.URL, method="POST",
+                          headers=headers, data=urllib.parse.urlencode({"data": data}).encode("ascii"))
 
-    def send_temperature(self, temperature):
-        now = datetime.now(tz=UTC)
-        date = now.strftime("%Y%m%d")
-        time = now.strftime("%H:%M")
-        url = self.__url.format(date=date, time=time, temperature=temperature)
-        self.logger.debug("Sending %s", url)
-        with urllib.request.urlopen(url) as f:
-            # OK 200: Added Status
-            response = f.read(300)
-            self.logger.debug(response)
+    def upload(self):
+        # One batch at a time, the next one is sent once the previous one has been answered
+        now = self.clock.now().timestamp()
+        statuses = self.__spool.peek(PVOutput.BATCH_SIZE)
+        stale = sum(1 for timestamp, _ in statuses if timestamp < now - PVOutput.MAX_AGE)
+        if stale:
+            self.logger.warning("Dropping %d statuses too old for PVOutput", stale)
+            self.__spool.remove(stale)
+            statuses = self.__spool.peek(PVOutput.BATCH_SIZE)
+        if not statuses or self.__batches >= PVOutput.MAX_BATCHES:
+            self.__uploading = False
+            self.__failures = 0
+            self.__next_upload = now + self.__upload_interval
+            return
+        self.__uploading = True
+        self.__batches += 1
+        self.send_statuses(statuses)
+
+    def update(self, count, response, error):
+        if isinstance(error, TimeoutError):
+            self.__retry_later("timeout")
+        elif error is not None:
+            self.__retry_later(str(error))
+        elif response.status == 400:
+            # Rejected, sending them again would not help
+            self.logger.error("Dropping %d statuses: %s", count, response.body[:300])
+            self.__spool.remove(count)
+            self.upload()
+        elif response.status != 200:
+            self.__retry_later(f"HTTP {response.status}")
+        else:
+            # One "date,time,1" per added status
+            self.logger.debug(response.body[:300])
+            self.__spool.remove(count)
+            self.upload()
+
+    def __retry_later(self, reason):
+        self.__uploading = False
+        self.__failures += 1
+        backoff = min(self.__delay * 2 ** self.__failures, PVOutput.MAX_BACKOFF)
+        self.__next_upload = self.clock.now().timestamp() + backoff
+        self.logger.error("Unable to upload to pvoutput.org: %s. %d statuses spooled, retrying in %ds",
+                          reason, len(self.__spool), backoff)
 
     def run(self, delay=300):
         self.run_internal(delay)
@@ -54,13 +176,17 @@ class PVOutput(WattPilotActor):
     def run_internal(self, delay):
         try:
             temperature = self.__temperature.get_temperature().get()
-            self.send_temperature(temperature)
-        except TimeoutError:
-            self.logger.error("Timeout connecting to pvoutput.org")
-        except urllib.error.URLError as exception:
-            self.logger.error("Unable to download data: %s", str(exception.reason))
+            now = self.clock.now().timestamp()
+            self.__spool.append(now, temperature)
+            self.__delay = delay
+            if not self.__uploading and now >= self.__next_upload:
+                self.__batches = 0
+                self.upload()
         finally:
             self.do_delay(delay, "run_internal", args=[delay])
 
+    def get_spooled(self):
+        return len(self.__spool)
+
     def get_temperature(self):
         return self.__temperature
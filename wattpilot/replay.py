@@ -0,0 +1,246 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import bisect
+import csv
+from array import array
+from datetime import UTC, datetime
+
+from .actor import WattPilotActor
+from .clock import VirtualClock
+from .wattpilot import WattPilot
+
+
+class Trace:
+    # CSV with timestamp (epoch or ISO 8601), power without the loads, temperature and cloudiness. An
+    # empty cell keeps the previous value in time, a sample holds until the next one
+
+    def __init__(self, timestamps, power, temperature, cloudiness):
+        assert timestamps
+        assert len(timestamps) == len(power) == len(temperature) == len(cloudiness)
+        self.timestamps = array("d", timestamps)
+        self.power = array("d", power)
+        self.temperature = array("d", temperature)
+        self.cloudiness = array("d", cloudiness)
+
+    @staticmethod
+    def __timestamp(value):
+        try:
+            return float(value)
+        except ValueError:
+            timestamp = datetime.fromisoformat(value)
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=UTC)
+            return timestamp.timestamp()
+
+    @staticmethod
+    def from_csv(lines):
+        # Sorted before carrying the missing values over, in time order
+        rows = sorted(((Trace.__timestamp(row["timestamp"]), row) for row in csv.DictReader(lines)),
+                      key=lambda item: item[0])
+        if not rows:
+            raise ValueError("Empty trace")
+        samples = []
+        temperature, cloudiness = 100, 100
+        for timestamp, row in rows:
+            temperature = float(row["temperature"] or temperature)
+            cloudiness = float(row["cloudiness"] or cloudiness)
+            samples.append((timestamp, float(row["power"]), temperature, cloudiness))
+        return Trace(*zip(*samples, strict=True))
+
+    @property
+    def start(self):
+        return self.timestamps[0]
+
+    @property
+    def end(self):
+        return self.timestamps[-1]
+
+    def index(self, timestamp):
+        return max(bisect.bisect_right(self.timestamps, timestamp) - 1, 0)
+
+
+class ReplayGpio:
+    # Records the switches instead of driving relays
+
+    def __init__(self, clock):
+        self.__clock = clock
+        self.pins = {}
+        self.switches = []
+
+    def setup(self, pin):
+        self.pins[pin] = False
+
+    def cleanup(self):
+        pass
+
+    def set_pins(self, values):
+        for pin, value in values.items():
+            if self.pins[pin] != value:
+                self.switches.append((self.__clock.now().timestamp(), pin, value))
+                self.pins[pin] = value
+
+    def set_pin(self, pin, value):
+        self.set_pins({pin: value})
+
+    def get_pin(self, pin):
+        return self.pins[pin]
+
+    def verify(self):
+        # Nothing can change the recorded outputs behind WattPilot's back
+        return True
+
+
+class TracePower(WattPilotActor):
+    # Stands in for Fronius, the loads switched on are added to the recorded power
+
+    def __init__(self, trace, gpio, loads):
+        super().__init__()
+        self.__trace = trace
+        self.__gpio = gpio
+        self.__loads = loads
+        self.__callback = None
+
+    def register_callback(self, callback):
+        self.__callback = callback
+
+    def run(self, delay=30):
+        self.run_internal(delay)
+
+    def run_internal(self, delay):
+        timestamp = self.clock.now().timestamp()
+        power = self.__trace.power[self.__trace.index(timestamp)]
+        power += sum(load for pin, load in self.__loads.items() if self.__gpio.get_pin(pin))
+        if self.__callback:
+            self.__callback.defer(power, timestamp)
+        self.do_delay(delay, "run_internal", args=[delay])
+
+
+class TraceTemperature(WattPilotActor):
+    # Stands in for Temperature, the boiler does not warm up
+
+    def __init__(self, trace):
+        super().__init__()
+        self.__trace = trace
+        self.__subscribers = []
+
+    def subscribe(self, callback):
+        self.__subscribers.append(callback)
+
+    def run(self, delay=60):
+        self.run_internal(delay)
+
+    def run_internal(self, delay):
+        timestamp = self.clock.now().timestamp()
+        temperature = self.__trace.temperature[self.__trace.index(timestamp)]
+        for callback in self.__subscribers:
+            callback.defer(temperature, timestamp)
+        self.do_delay(delay, "run_internal", args=[delay])
+
+
+class TraceWeather(WattPilotActor):
+    # Stands in for OpenWeatherMap, the recorded cloudiness is the forecast
+
+    def __init__(self, trace):
+        super().__init__()
+        self.__trace = trace
+
+    def run(self, delay=3600):
+        pass
+
+    def get_cloudiness(self, start=None, end=None):
+        # The recorded cloudiness, whatever the window
+        return self.__trace.cloudiness[self.__trace.index(self.clock.now().timestamp())]
+
+
+def get_loads(config):
+    sections = [section for section in config.sections() if section.startswith("load_")]
+    return {config.getint(section, "pin"): config.getint(section, "power") for section in sorted(sections)}
+
+
+def account(trace, switches, transitions, loads, end):
+    # Integrate between every change of the recorded power or of the loads, the values are steps
+    report = {
+        "switches": len(switches),
+        "diverted": 0.0,
+        "imported": 0.0,
+        "exported": 0.0,
+        "time_in_state": {},
+    }
+    changes = sorted({timestamp for timestamp in trace.timestamps if timestamp < end} |
+                     {timestamp for timestamp, _, _ in switches if timestamp < end} | {trace.start})
+    pins = dict.fromkeys(loads, False)
+    position = 0
+    for start, stop in zip(changes, [*changes[1:], end], strict=True):
+        while position < len(switches) and switches[position][0] <= start:
+            _, pin, value = switches[position]
+            pins[pin] = value
+            position += 1
+        hours = (stop - start) / 3600
+        diverted = sum(power for pin, power in loads.items() if pins[pin])
+        grid = trace.power[trace.index(start)] + diverted
+        report["diverted"] += diverted * hours
+        report["imported"] += max(grid, 0) * hours
+        report["exported"] += max(-grid, 0) * hours
+    time_in_state = report["time_in_state"]
+    for (start, state), (stop, _) in zip(transitions, [*transitions[1:], (end, None)], strict=True):
+        time_in_state[state] = time_in_state.get(state, 0) + stop - start
+    return report
+
+
+def replay(config, trace):
+    # As fast as possible, returns the report
+    clock = VirtualClock(datetime.fromtimestamp(trace.start, tz=UTC))
+    real_clock, WattPilotActor.clock = WattPilotActor.clock, clock
+    loads = get_loads(config)
+    gpio = ReplayGpio(clock)
+    actors = []
+    try:
+        power = TracePower.start(trace, gpio, loads)
+        temperature = TraceTemperature.start(trace)
+        weather = TraceWeather.start(trace)
+        actors += [power, temperature, weather]
+        wattpilot = WattPilot.start(config, power.proxy(), gpio, weather.proxy(), temperature.proxy())
+        actors.append(wattpilot)
+        wattpilot = wattpilot.proxy()
+        temperature.proxy().run().get()
+        wattpilot.idle.defer()
+        # The state history is bounded, fetch it one day at a time
+        transitions = {}
+        now = trace.start
+        while now < trace.end:
+            now = min(now + 86400, trace.end)
+            clock.run_until(datetime.fromtimestamp(now, tz=UTC))
+            transitions.update(wattpilot.get_state_history(trace.start, now).get())
+        return account(trace, gpio.switches, sorted(transitions.items()), loads, trace.end)
+    finally:
+        for actor in reversed(actors):
+            actor.stop()
+        WattPilotActor.clock = real_clock
+
+
+def format_report(report):
+    lines = [
+        f"Switches: {report['switches']}",
+        f"Energy diverted: {report['diverted'] / 1000:.2f}kWh",
+        f"Grid import: {report['imported'] / 1000:.2f}kWh",
+        f"Grid export: {report['exported'] / 1000:.2f}kWh",
+    ]
+    for state, seconds in sorted(report["time_in_state"].items()):
+        lines.append(f"Time in {state}: {seconds / 3600:.2f}h")
+    return "\n".join(lines) + "\n"
+
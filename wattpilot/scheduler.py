@@ -0,0 +1,110 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+
+    __slots__ = ("active", "args", "deadline", "function", "kwargs", "scheduler", "sequence")
+
+    def __init__(self, scheduler, deadline, sequence, function, args, kwargs):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.sequence = sequence
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.active = True
+
+    def __lt__(self, other):
+        return (self.deadline, self.sequence) < (other.deadline, other.sequence)
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+
+class Scheduler:
+    # Runs the delayed calls from one thread. Timers are in a heap by deadline, a cancelled one is
+    # only marked and dropped lazily
+
+    def __init__(self, name="wattpilot-scheduler"):
+        self.__name = name
+        self.__condition = threading.Condition()
+        self.__queue = []
+        self.__sequence = itertools.count()
+        self.__pending = 0
+        self.__thread = None
+
+    def schedule(self, delay, function, args=(), kwargs=None):
+        assert delay >= 0
+        with self.__condition:
+            deadline = time.monotonic() + delay
+            timer = Timer(self, deadline, next(self.__sequence), function, args, kwargs or {})
+            heapq.heappush(self.__queue, timer)
+            self.__pending += 1
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name=self.__name, daemon=True)
+                self.__thread.start()
+            # Wake up the thread only if the deadline to wait for has changed
+            if self.__queue[0] is timer:
+                self.__condition.notify()
+            return timer
+
+    def cancel(self, timer):
+        with self.__condition:
+            if timer.active:
+                timer.active = False
+                self.__pending -= 1
+                # Compact the heap once cancelled timers dominate it
+                if len(self.__queue) > 64 and self.__pending < len(self.__queue) // 2:
+                    self.__queue = [timer for timer in self.__queue if timer.active]
+                    heapq.heapify(self.__queue)
+
+    def pending(self):
+        return self.__pending
+
+    def __next_timer(self):
+        with self.__condition:
+            while True:
+                while self.__queue and not self.__queue[0].active:
+                    heapq.heappop(self.__queue)
+                if not self.__queue:
+                    self.__condition.wait()
+                    continue
+                timeout = self.__queue[0].deadline - time.monotonic()
+                if timeout > 0:
+                    self.__condition.wait(timeout)
+                    continue
+                timer = heapq.heappop(self.__queue)
+                timer.active = False
+                self.__pending -= 1
+                return timer
+
+    def __run(self):
+        while True:
+            timer = self.__next_timer()
+            try:
+                timer.function(*timer.args, **timer.kwargs)
+            except Exception:
+                logger.exception("Timer callback %s failed", timer.function)
@@ -0,0 +1,104 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from array import array
+
+
+class RingBuffer:
+    # Preallocated arrays, appended in timestamp order so that a range is a binary search
+
+    def __init__(self, capacity):
+        self.__capacity = capacity
+        self.__timestamps = array("d", bytes(8 * capacity))
+        self.__values = array("d", bytes(8 * capacity))
+        self.__start = 0
+        self.__size = 0
+
+    def __len__(self):
+        return self.__size
+
+    @property
+    def first(self):
+        # Oldest timestamp still held, None when empty
+        return self.__timestamp(0) if self.__size else None
+
+    def append(self, timestamp, value):
+        index = (self.__start + self.__size) % self.__capacity
+        self.__timestamps[index] = timestamp
+        self.__values[index] = value
+        if self.__size < self.__capacity:
+            self.__size += 1
+        else:
+            self.__start = (self.__start + 1) % self.__capacity
+
+    def __timestamp(self, position):
+        return self.__timestamps[(self.__start + position) % self.__capacity]
+
+    def __bisect(self, timestamp):
+        low, high = 0, self.__size
+        while low < high:
+            middle = (low + high) // 2
+            if self.__timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def range(self, start, end):
+        first, last = self.__bisect(start), self.__bisect(end)
+        indices = [(self.__start + position) % self.__capacity for position in range(first, last)]
+        return [self.__timestamps[index] for index in indices], [self.__values[index] for index in indices]
+
+
+def downsample(timestamps, values, start, end, points):
+    # At most points buckets of (timestamp, minimum, maximum, mean)
+    assert start < end
+    assert points > 0
+    width = (end - start) / points
+    buckets = []
+    bucket = None
+    for timestamp, value in zip(timestamps, values, strict=True):
+        index = int((timestamp - start) / width)
+        if bucket is None or index != bucket[0]:
+            bucket = [index, value, value, 0.0, 0]
+            buckets.append(bucket)
+        bucket[1] = min(bucket[1], value)
+        bucket[2] = max(bucket[2], value)
+        bucket[3] += value
+        bucket[4] += 1
+    return [(start + index * width, minimum, maximum, total / count)
+            for index, minimum, maximum, total, count in buckets]
+
+
+def merge(rollups, start, end, points):
+    # (timestamp, minimum, maximum, mean, count) rollups into at most points buckets
+    assert start < end
+    assert points > 0
+    width = (end - start) / points
+    buckets = []
+    bucket = None
+    for timestamp, minimum, maximum, mean, count in rollups:
+        index = max(int((timestamp - start) / width), 0)
+        if bucket is None or index != bucket[0]:
+            bucket = [index, minimum, maximum, 0.0, 0]
+            buckets.append(bucket)
+        bucket[1] = min(bucket[1], minimum)
+        bucket[2] = max(bucket[2], maximum)
+        bucket[3] += mean * count
+        bucket[4] += count
+    return [(start + index * width, minimum, maximum, total / count)
+            for index, minimum, maximum, total, count in buckets]
@@ -0,0 +1,117 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import logging
+
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from connexion.middleware import MiddlewarePosition
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTimeoutMiddleware:
+    # 503 when the response did not start in time. The handler keeps running, whatever it sends
+    # afterwards is discarded
+
+    def __init__(self, app, timeout):
+        self.app = app
+        self.timeout = timeout
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.timeout:
+            await self.app(scope, receive, send)
+            return
+
+        started = asyncio.Event()
+        timed_out = False
+
+        async def guarded_send(message):
+            if timed_out:
+                return
+            if message["type"] == "http.response.start":
+                started.set()
+            await send(message)
+
+        task = asyncio.ensure_future(self.app(scope, receive, guarded_send))
+        waiter = asyncio.ensure_future(started.wait())
+        await asyncio.wait([task, waiter], timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        if started.is_set() or task.done():
+            await task
+            return
+
+        timed_out = True
+        # Nobody awaits the task anymore, retrieve its exception to keep asyncio quiet
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        logger.warning("Request %s %s timed out after %.1fs", scope["method"], scope["path"], self.timeout)
+        await send({"type": "http.response.start", "status": 503, "headers": [(b"content-length", b"0")]})
+        await send({"type": "http.response.body", "body": b""})
+
+
+class StreamLimitMiddleware:
+    # An event stream holds a worker thread for as long as it is open, even a while after the client
+    # left. Past the limit, new streams get 503 and the other threads stay free for the other requests
+
+    def __init__(self, app, limit, suffix="/events"):
+        self.app = app
+        self.limit = limit
+        self.suffix = suffix
+        # Only changed from the event loop
+        self.streams = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].endswith(self.suffix):
+            await self.app(scope, receive, send)
+            return
+        if self.streams >= self.limit:
+            logger.warning("Too many event streams, %d already open", self.streams)
+            await send({"type": "http.response.start", "status": 503, "headers": [(b"content-length", b"0")]})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        self.streams += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.streams -= 1
+
+
+def set_workers(app, threads):
+    # The pool is owned by connexion, there is no public API to configure it. Its version is pinned,
+    # the tests fail if an upgrade moves the pool
+    if not isinstance(app._middleware_app.asgi_app, WSGIMiddleware):
+        raise RuntimeError("Unable to size the thread pool with this connexion version")
+    app._middleware_app.asgi_app = WSGIMiddleware(app.app.wsgi_app, workers=threads)
+
+
+def serve(app, host, port, threads=10, keep_alive=5, timeout=30):
+    # Handlers run in a thread pool, event streams may only take half of it
+    streams = max(threads // 2, 1)
+    set_workers(app, threads)
+    app.add_middleware(StreamLimitMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION, limit=streams)
+    app.add_middleware(RequestTimeoutMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION, timeout=timeout)
+    config = uvicorn.Config(
+        app,
+        host=host,
+        port=port,
+        timeout_keep_alive=keep_alive,
+        log_config=None,
+        access_log=False,
+    )
+    logger.info("Serving on %s:%d with %d threads, at most %d event streams", host, port, threads, streams)
+    uvicorn.Server(config).run()
@@ -0,0 +1,92 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import collections
+import threading
+import uuid
+from types import MappingProxyType
+
+
+class Subscription:
+    # Bounded queue of changes, the oldest ones are dropped when the reader is too slow
+
+    def __init__(self, status, maxlen):
+        self.__status = status
+        self.__events = collections.deque(maxlen=maxlen)
+        self.__condition = threading.Condition()
+        self.dropped = 0
+
+    def put(self, event):
+        with self.__condition:
+            if len(self.__events) == self.__events.maxlen:
+                self.dropped += 1
+            self.__events.append(event)
+            self.__condition.notify()
+
+    def get(self, timeout=None):
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__events, timeout)
+            events = list(self.__events)
+            self.__events.clear()
+            return events
+
+    def close(self):
+        self.__status.unsubscribe(self)
+
+
+class Status:
+    # Read-only snapshot rebuilt on every change, read without locking nor asking the actors
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # Tell snapshots from different runs apart
+        self.__instance = uuid.uuid4().hex[:8]
+        self.__version = 0
+        self.__snapshot = MappingProxyType({})
+        self.__subscriptions = set()
+
+    def update(self, **values):
+        with self.__lock:
+            changes = {key: value for key, value in values.items()
+                       if key not in self.__snapshot or self.__snapshot[key] != value}
+            if not changes:
+                return
+            snapshot = dict(self.__snapshot)
+            snapshot.update(changes)
+            self.__version += 1
+            self.__snapshot = MappingProxyType(snapshot)
+            for subscription in self.__subscriptions:
+                subscription.put((self.__version, changes))
+
+    def subscribe(self, maxlen=100):
+        # The first event holds the whole snapshot, the following ones only what changed
+        subscription = Subscription(self, maxlen)
+        with self.__lock:
+            subscription.put((self.__version, dict(self.__snapshot)))
+            self.__subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.__lock:
+            self.__subscriptions.discard(subscription)
+
+    def get(self):
+        with self.__lock:
+            return f'"{self.__instance}-{self.__version}"', self.__snapshot
+
+
+status = Status()
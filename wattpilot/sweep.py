@@ -0,0 +1,215 @@
+# WattPilot - Optimize your energy consumption
+# Copyright (C) 2020 Cyril Jaquier
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import argparse
+import configparser
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Final
+
+import numpy as np
+
+from .replay import Trace, get_loads
+
+PARAMETERS: Final = (
+    "hysteresis_to_grid",
+    "hysteresis_from_grid",
+    "temperature_solar",
+    "temperature_schedule",
+    "cloudiness_level",
+)
+
+IDLE, SOLAR, SCHEDULE = 0, 1, 2
+
+
+class Model:
+    # WattPilot's decisions for many parameter combinations at once, one row of the state arrays each
+
+    def __init__(self, trace, loads, schedule_start, schedule_stop):
+        self.timestamps = np.asarray(trace.timestamps)
+        self.power = np.asarray(trace.power)
+        self.temperature = np.asarray(trace.temperature)
+        self.cloudiness = np.asarray(trace.cloudiness)
+        self.loads = np.array(list(loads.values()), dtype=float)
+        # Every subset of the loads, row i holds the loads whose bit is set in i
+        masks = np.arange(1 << len(self.loads))
+        self.subsets = (masks[:, np.newaxis] >> np.arange(len(self.loads))) & 1 == 1
+        self.sums = self.subsets @ self.loads
+        self.bits = self.subsets.sum(axis=1)
+        self.schedule_start = schedule_start
+        self.schedule_stop = schedule_stop
+
+    def simulate(self, combinations):
+        h_to, h_from, t_solar, t_schedule, cloudiness_level = np.asarray(combinations, dtype=float).T
+        count = len(h_to)
+        mode = np.full(count, IDLE)
+        active = np.zeros((count, len(self.loads)), dtype=bool)
+        results = {
+            "switches": np.zeros(count, dtype=np.int64),
+            "solar": np.zeros(count),
+            "diverted": np.zeros(count),
+            "imported": np.zeros(count),
+        }
+        hours = (self.timestamps % 86400) // 3600
+        durations = np.diff(self.timestamps, append=self.timestamps[-1]) / 3600
+        minimum = self.loads.min(initial=0)
+        for step, duration in enumerate(durations):
+            base = self.power[step]
+            hour = hours[step]
+            temperature = self.temperature[step]
+            grid = base + active @ self.loads
+            previous = active.copy()
+            idle = mode == IDLE
+            solar = mode == SOLAR
+            schedule = mode == SCHEDULE
+
+            # Idle, enough exported power for the smallest load starts solar, otherwise maybe the schedule
+            enough = minimum + h_to <= -grid
+            to_solar = idle & enough & (temperature < t_solar - 1)
+            to_schedule = idle & ~enough & (self.cloudiness[step] > cloudiness_level) & \
+                (temperature < t_schedule - 1) & (self.schedule_start <= hour < self.schedule_stop)
+
+            # Schedule, until the end of the period or the water is warm
+            stop = schedule & ((hour >= self.schedule_stop) | (temperature > t_schedule + 0.5))
+
+            # Solar, the subset of the loads using the most of the available power, the fewest switches
+            # away on a tie. Shed loads when importing, only add loads when exporting.
+            too_hot = solar & (temperature > t_solar + 0.5)
+            importing = solar & ~too_hot & (grid > h_from)
+            active_power = active @ self.loads
+            target = np.where(importing, active_power - grid + h_from, active_power - grid - h_to)
+            fitting = self.sums <= target[:, np.newaxis]
+            best = np.where(fitting, self.sums, -1).max(axis=1, keepdims=True)
+            current = active @ (1 << np.arange(len(self.loads)))
+            distance = self.bits[current[:, np.newaxis] ^ np.arange(len(self.sums))]
+            subset = np.where(fitting & (self.sums == best), distance, len(self.loads) + 1).argmin(axis=1)
+            stop |= too_hot | (importing & (subset == 0))
+            change = (importing & ~stop) | (solar & ~too_hot & ~importing & (self.sums[subset] > active_power))
+            active[change] = self.subsets[subset[change]]
+
+            mode[stop] = IDLE
+            active[stop] = False
+            mode[to_solar] = SOLAR
+            mode[to_schedule] = SCHEDULE
+            active[to_schedule] = True
+
+            diverted = active @ self.loads
+            results["switches"] += (active != previous).sum(axis=1)
+            results["diverted"] += diverted * duration
+            results["solar"] += np.minimum(diverted, max(-base, 0)) * duration
+            results["imported"] += np.maximum(base + diverted, 0) * duration
+        return results
+
+    def surplus(self):
+        # Energy exported without any load, the most that could be diverted
+        durations = np.diff(self.timestamps, append=self.timestamps[-1]) / 3600
+        return float(np.maximum(-self.power, 0) @ durations)
+
+
+def parse_values(text):
+    # A single value, a list "a,b,c" or an inclusive range "start:stop:step"
+    if ":" in text:
+        start, stop, step = (float(value) for value in text.split(":"))
+        if step <= 0:
+            raise ValueError(f"Invalid step: {text}")
+        return np.arange(start, stop + step / 2, step)
+    return np.array([float(value) for value in text.split(",")])
+
+
+def combine(values):
+    # Cartesian product of the values of every parameter, one combination per row
+    return np.stack(np.meshgrid(*values, indexing="ij"), axis=-1).reshape(-1, len(values))
+
+
+_model = None
+
+
+def _initialize(model):
+    global _model
+    _model = model
+
+
+def _simulate(combinations):
+    return _model.simulate(combinations)
+
+
+def sweep(model, combinations, workers=None):
+    # On a pool of processes, one chunk of rows per task
+    workers = workers or os.cpu_count()
+    chunks = np.array_split(combinations, min(len(combinations), workers * 4))
+    # The model is sent once to every process, not with every chunk
+    with ProcessPoolExecutor(workers, initializer=_initialize, initargs=(model,)) as executor:
+        results = list(executor.map(_simulate, chunks))
+    return {key: np.concatenate([result[key] for result in results]) for key in results[0]}
+
+
+def pareto(results):
+    # Indexes of the combinations diverting more solar energy than all those switching less often
+    order = np.lexsort((-results["solar"], results["switches"]))
+    front = []
+    for index in order:
+        if not front or results["solar"][index] > results["solar"][front[-1]]:
+            front.append(index)
+    return front
+
+
+def format_table(combinations, results, front, surplus):
+    columns = ["switches", "self_consumption", "solar_kwh", "imported_kwh", *PARAMETERS]
+    lines = ["\t".join(columns)]
+    for index in front:
+        share = results["solar"][index] / surplus if surplus else 0
+        values = [
+            f"{results['switches'][index]}",
+            f"{share:.1%}",
+            f"{results['solar'][index] / 1000:.2f}",
+            f"{results['imported'][index] / 1000:.2f}",
+            *(f"{value:g}" for value in combinations[index]),
+        ]
+        lines.append("\t".join(values))
+    return "\n".join(lines) + "\n"
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Sweep the WattPilot parameters over a recorded trace")
+    parser.add_argument("trace", help="CSV trace, see wattpilot.replay.Trace")
+    parser.add_argument("--config", default="config.ini", help="configuration with the loads and the schedule")
+    parser.add_argument("--workers", type=int, help="number of processes")
+    for name in PARAMETERS:
+        parser.add_argument(f"--{name.replace('_', '-')}", metavar="VALUES",
+                            help="value, list a,b,c or range start:stop:step (default from the configuration)")
+    args = parser.parse_args(args)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    sections = {"temperature_solar": "temperature", "temperature_schedule": "temperature"}
+    values = []
+    for name in PARAMETERS:
+        text = getattr(args, name) or config.get(sections.get(name, "main"), name)
+        values.append(parse_values(text))
+    combinations = combine(values)
+
+    with open(args.trace, newline="") as f:
+        trace = Trace.from_csv(f)
+    model = Model(trace, get_loads(config), config.getint("main", "schedule_start"),
+                  config.getint("main", "schedule_stop"))
+    results = sweep(model, combinations, args.workers)
+    sys.stdout.write(format_table(combinations, results, pareto(results), model.surplus()))
+
+
+if __name__ == "__main__":
+    main()
@@ -18,28 +18,76 @@
 import logging
 
 from .actor import WattPilotActor
+from .series import RingBuffer, downsample
+from .status import status
 
 
 class Temperature(WattPilotActor):
 
-    def __init__(self, config, sensor):
+    # Four days of readings
+    HISTORY_SIZE = 4 * 24 * 60
+
+    def __init__(self, config, sensors):
         super().__init__()
         self.logger = logging.getLogger(__name__)
-        self.__sensor = sensor
+        self.__sensors = sensors
+        # The sensor driving the loads, the others are only published
+        self.__control = config.get("temperature", "sensor", fallback=sensors.names[0])
         self.__temperature = 100
+        self.__temperatures = {}
+        self.__timestamp = None
+        self.__subscribers = []
+        self.__history = RingBuffer(Temperature.HISTORY_SIZE)
+
+    def on_stop(self):
+        super().on_stop()
+        self.__sensors.close()
+
+    def subscribe(self, callback):
+        self.logger.info("Subscribe: %s", callback)
+        self.__subscribers.append(callback)
+        # Hand out the last reading right away
+        if self.__timestamp is not None:
+            callback.defer(self.__temperature, self.__timestamp)
 
     def run(self, delay=60):
         self.run_internal(delay)
 
     def run_internal(self, delay):
         try:
-            self.__temperature = self.__sensor.value()
-            self.logger.info("Temperature: %.1f", self.__temperature)
-        except OSError:
-            self.logger.exception("Unable to read temperature. Returning high value")
-            self.__temperature = 100
+            # The sensors are read on their own threads, the readings come back as a message
+            self.__sensors.read(self._proxy.set_readings.defer)
         finally:
             self.do_delay(delay, "run_internal", args=[delay])
 
+    def set_readings(self, readings):
+        # (value, timestamp) by sensor, the time the value was read, not received
+        self.__temperatures = {name: value for name, (value, _) in readings.items()}
+        status.update(temperatures=self.__temperatures)
+        temperature, timestamp = readings.get(self.__control, (None, None))
+        if temperature is None:
+            self.logger.error("No valid reading from sensor %s. Returning high value", self.__control)
+            self.__temperature = 100
+            return
+        self.__temperature = temperature
+        if timestamp == self.__timestamp:
+            # Last good value of a sensor which did not answer, already published
+            return
+        self.__timestamp = timestamp
+        self.logger.info("Temperature: %.1f", self.__temperature)
+        self.__history.append(self.__timestamp, self.__temperature)
+        status.update(temperature=self.__temperature, temperature_timestamp=self.__timestamp)
+        for callback in self.__subscribers:
+            callback.defer(self.__temperature, self.__timestamp)
+
     def get_temperature(self):
         return self.__temperature
+
+    def get_temperatures(self):
+        return self.__temperatures
+
+    def get_history(self, start, end, points):
+        return downsample(*self.__history.range(start, end), start, end, points)
+
+    def get_history_start(self):
+        return self.__history.first
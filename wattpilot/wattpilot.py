@@ -15,19 +15,35 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import copy
+import bisect
+import dataclasses
+import heapq
 import logging
-from datetime import UTC, datetime
+import math
+import time
+from datetime import UTC, datetime, timedelta
 from typing import Final
 
+import pykka
+
 from .actor import WattPilotActor, WattPilotModel
+from .status import status
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class LoadSnapshot:
+    pin: int
+    power: int
+    # Timestamp at which the load was switched on
+    since: float
+    # Energy in Wh used until the load was switched on, the current period is not counted
+    energy: float
 
 
 class Load:
 
     def __init__(self, gpio, pin):
         self.__pin = pin
-        self.__gpio = gpio
         self.power = 0
         gpio.setup(pin)
 
@@ -35,14 +51,11 @@ class Load:
     def pin(self):
         return self.__pin
 
-    def set_pin(self, value):
-        self.__gpio.set_pin(self.__pin, value)
-
-    def get_pin(self):
-        return self.__gpio.get_pin(self.__pin)
-
 
 class AllLoad:
+    # A set of loads is an integer with bit i set for load i, its power is looked up in a table
+
+    MAX_LOADS = 16
 
     @staticmethod
     def from_config(config, gpio):
@@ -51,34 +64,70 @@ class AllLoad:
         for section in sorted(sections):
             load = Load(gpio, config.getint(section, "pin"))
             load.power = config.getint(section, "power")
-            all_load.get_all_loads().append(load)
+            all_load.add_load(load)
         return all_load
 
     def __init__(self, gpio):
         self.__gpio = gpio
         self.__loads = []
+        self.__all = 0
+        # Indexed by set: total power and power of the smallest load not in the set
+        self.__power = [0]
+        self.__minimum = [math.inf]
+        # (power, set) of every set sorted by power
+        self.__combinations = [(0, 0)]
+
+    def add_load(self, load):
+        if len(self.__loads) == AllLoad.MAX_LOADS:
+            raise ValueError(f"At most {AllLoad.MAX_LOADS} loads are supported")
+        bit = 1 << len(self.__loads)
+        self.__loads.append(load)
+        self.__all |= bit
+        # The sets without the new load come first, followed by the same sets with it
+        self.__power += [power + load.power for power in self.__power]
+        self.__minimum = [min(minimum, load.power) for minimum in self.__minimum] + self.__minimum
+        self.__combinations = list(heapq.merge(
+            self.__combinations, [(power + load.power, loads | bit) for power, loads in self.__combinations]))
 
     def get_all_loads(self):
         return self.__loads
 
-    def get_inactive_loads(self, active_loads):
-        return [load for load in self.__loads if load not in active_loads]
+    def get_all(self):
+        return self.__all
+
+    def get_loads(self, loads):
+        return [load for index, load in enumerate(self.__loads) if loads & (1 << index)]
+
+    def get_pins(self, loads):
+        return tuple(load.pin for load in self.get_loads(loads))
 
-    def get_minimum_power(self, active_loads):
-        inactive = self.get_inactive_loads(active_loads)
-        return min([load.power for load in inactive]) if inactive else 0
+    def get_inactive(self, loads):
+        return self.__all & ~loads
+
+    def switch(self, active, loads):
+        # All the pins at once, those switched off first
+        changes = {load.pin: False for load in self.get_loads(active & ~loads)}
+        changes.update({load.pin: True for load in self.get_loads(loads & ~active)})
+        if changes:
+            self.__gpio.set_pins(changes)
+
+    def get_power(self, loads):
+        return self.__power[loads]
+
+    def get_minimum_power(self, loads):
+        minimum = self.__minimum[loads]
+        return 0 if minimum == math.inf else minimum
 
     def get_minimum_load(self):
-        return sorted(self.__loads, lambda x: x.power)[0]
+        return min(self.__loads, key=lambda x: x.power) if self.__loads else None
 
-    def get_load(self, power, active_loads):
-        loads = []
-        for load in self.get_inactive_loads(active_loads):
-            if load.power <= power:
-                loads.append(load)
-        if loads:
-            return sorted(loads, key=lambda x: x.power, reverse=True)[0]
-        return None
+    def get_best_loads(self, power, active):
+        # The set using the most of the power, the fewest switches away from the active one on a tie
+        end = bisect.bisect_right(self.__combinations, power, key=lambda x: x[0])
+        if end == 0:
+            return 0
+        start = bisect.bisect_left(self.__combinations, self.__combinations[end - 1][0], key=lambda x: x[0])
+        return min((loads for _, loads in self.__combinations[start:end]), key=lambda x: (x ^ active).bit_count())
 
 
 class WattPilot(WattPilotActor):
@@ -99,7 +148,8 @@ class WattPilot(WattPilotActor):
         self.logger = logging.getLogger(__name__)
 
         # Initialize the state machine
-        self.__machine = WattPilotModel(model=self, states=WattPilot.states, initial="halt")
+        self.__machine = WattPilotModel(model=self, states=WattPilot.states, initial="halt",
+                                      clock=self.clock)
 
         # Transitions
         self.__machine.add_transition("halt", "*", "halt")
@@ -120,11 +170,20 @@ class WattPilot(WattPilotActor):
         self.__machine.add_transition("solar", "idle", "solar")
         self.__machine.add_transition("update_power", "solar", None, after=self.after_solar_power)
 
+        self.__gpio = gpio
         self.__loads = AllLoad.from_config(config, gpio)
-        self.__active_loads = []
+        # Bit i set when load i is on
+        self.__active = 0
+        self.__snapshots = ()
+        self.__energy = {}
         self.__power = power
+        self.__power_value = None
+        self.__power_timestamp = None
         self.__weather = weather
+        self.__cloudiness = 100
         self.__temperature = temperature
+        self.__temperature_value = None
+        self.__temperature_timestamp = None
 
         self.__hysteresis_to_grid = config.getint("main", "hysteresis_to_grid")
         self.__hysteresis_from_grid = config.getint("main", "hysteresis_from_grid")
@@ -132,21 +191,87 @@ class WattPilot(WattPilotActor):
         self.__schedule_start = config.getint("main", "schedule_start")
         self.__schedule_stop = config.getint("main", "schedule_stop")
         self.__cloudiness_level = config.getint("main", "cloudiness_level")
+        self.__forecast_start = config.getint("main", "forecast_start", fallback=None)
+        self.__forecast_stop = config.getint("main", "forecast_stop", fallback=None)
+        self.__input_timeout = config.getfloat("main", "input_timeout", fallback=2.0)
         self.__temperature_schedule = config.getint("temperature", "temperature_schedule")
         self.__temperature_solar = config.getint("temperature", "temperature_solar")
+        self.__temperature_max_age = config.getint("temperature", "max_age", fallback=300)
+        self.__power_max_age = config.getint("main", "power_max_age", fallback=180)
+        self.__verify_interval = config.getfloat("main", "gpio_verify_interval", fallback=0)
+        self.__verify_timer = None
+
+    def on_start(self):
+        status.update(cloudiness_level=self.__cloudiness_level, schedule_trigger=self.__schedule_trigger)
+        self.__temperature.subscribe.defer(self._proxy.set_temperature)
+        self.__schedule_verify()
+
+    def on_stop(self):
+        if self.__verify_timer:
+            self.__verify_timer.cancel()
+        super().on_stop()
+
+    def __schedule_verify(self):
+        # Own timer, do_delay() is cancelled on every transition
+        if self.__verify_interval:
+            self.__verify_timer = self.clock.schedule(self.__verify_interval, self._proxy.verify_outputs.defer)
+
+    def verify_outputs(self):
+        # Run by the actor, never in the middle of a switch. Catches the outputs which changed while
+        # the loads stay the same
+        self.__gpio.verify()
+        self.__schedule_verify()
+
+    def get_state_history(self, start, end):
+        return self.__machine.get_state_history(start, end)
 
     def get_active_loads(self):
-        return copy.deepcopy(self.__active_loads)
+        # Immutable, handed out as is
+        return self.__snapshots
+
+    def __publish_loads(self):
+        status.update(loads=self.__loads.get_pins(self.__active))
 
     def __stop_all_active(self):
-        for load in self.__active_loads:
-            load.set_pin(False)
-        self.__active_loads = []
+        self.__switch_loads(0)
 
     def __start_all_inactive(self):
-        for load in self.__loads.get_inactive_loads(self.__active_loads):
-            load.set_pin(True)
-            self.__active_loads.append(load)
+        self.__switch_loads(self.__loads.get_all())
+
+    def set_power(self, power, timestamp, repeated=False):
+        # Pushed by the power source on every new sample, and repeated when it cannot get a new one
+        if repeated:
+            # Already used, the loads may have changed since. Only its age matters
+            age = self.clock.now().timestamp() - timestamp
+            self.logger.debug("No new power sample for %ds", age)
+            if self.is_solar() and age > self.__power_max_age:
+                self.logger.warning("No recent power reading, stopping the loads")
+                self.do_delay(0, "idle")
+            return
+        self.logger.debug("Power sample: %.2fW at %s", power, datetime.fromtimestamp(timestamp, tz=UTC))
+        self.__power_value = power
+        self.__power_timestamp = timestamp
+        self.update_power()
+        if self.is_solar():
+            # Watchdog, the loads go off if no new sample arrives
+            self.__arm_power_watchdog()
+
+    def __arm_power_watchdog(self):
+        self.do_delay(self.__power_max_age, "idle")
+
+    def __get_power(self):
+        # None when unknown or too old to act on
+        if self.__power_timestamp is None:
+            return None
+        age = self.clock.now().timestamp() - self.__power_timestamp
+        if age > self.__power_max_age:
+            self.logger.warning("Power reading is %ds old", age)
+            return None
+        return self.__power_value
+
+    def __clear_power(self):
+        self.__power_value = None
+        self.__power_timestamp = None
 
     def on_enter_halt(self):
         self.logger.info("Entering halt state")
@@ -160,35 +285,88 @@ class WattPilot(WattPilotActor):
     def on_enter_idle(self):
         self.logger.info("Entering idle state")
         self.__stop_all_active()
-        self.__power.register_callback(self._proxy.update_power).get()
+        self.__clear_power()
+        self.__power.register_callback(self._proxy.set_power).get()
         self.__power.run.defer(60)
 
+    def __get_cloudiness(self):
+        # Do not let a busy weather actor stall the control loop, use the last known value instead
+        start = time.monotonic()
+        try:
+            self.__cloudiness = self.__weather.get_cloudiness(*self.__get_forecast_window()).get(
+                timeout=self.__input_timeout)
+        except pykka.Timeout:
+            self.logger.warning("No cloudiness after %.1fs, using last value: %d%%", self.__input_timeout,
+                                self.__cloudiness)
+        else:
+            elapsed = time.monotonic() - start
+            if elapsed > self.__input_timeout / 2:
+                self.logger.warning("Cloudiness took %.1fs", elapsed)
+        return self.__cloudiness
+
+    def __get_forecast_window(self):
+        # Next solar hours (e.g. tomorrow's at night), only the next forecast slot if not configured
+        if self.__forecast_start is None or self.__forecast_stop is None:
+            return ()
+        now = self.clock.now()
+        start = now.replace(hour=self.__forecast_start, minute=0, second=0, microsecond=0)
+        stop = start.replace(hour=self.__forecast_stop)
+        if now >= stop:
+            start += timedelta(days=1)
+            stop += timedelta(days=1)
+        return start.timestamp(), stop.timestamp()
+
     def get_scheduled_by_weather(self):
-        return self.__weather.get_cloudiness().get() > self.__cloudiness_level
+        # Publishes the cloudiness actually used, the mean over the forecast window when configured
+        cloudiness = self.__get_cloudiness()
+        will_run = cloudiness > self.__cloudiness_level
+        status.update(decision_cloudiness=cloudiness, will_run=will_run)
+        return will_run
+
+    def set_temperature(self, temperature, timestamp):
+        # Pushed by the temperature actor on every new reading
+        self.__temperature_value = temperature
+        self.__temperature_timestamp = timestamp
+
+    def __get_temperature(self):
+        if self.__temperature_timestamp is None:
+            self.logger.warning("No temperature reading yet. Assuming high value")
+            return 100
+        age = self.clock.now().timestamp() - self.__temperature_timestamp
+        if age > self.__temperature_max_age:
+            self.logger.warning("Temperature reading is %ds old. Assuming high value", age)
+            return 100
+        return self.__temperature_value
 
     def check_temperature_min(self, limit, hysteresis=1):
-        temperature = self.__temperature.get_temperature().get()
+        temperature = self.__get_temperature()
         check = temperature < limit - hysteresis
         if check:
             self.logger.info("Temperature low: %.2f", temperature)
         return check
 
     def check_temperature_max(self, limit, hysteresis=0.5):
-        temperature = self.__temperature.get_temperature().get()
+        temperature = self.__get_temperature()
         check = temperature > limit + hysteresis
         if check:
             self.logger.info("Temperature high: %.2f", temperature)
         return check
 
     def after_idle_power(self):
-        minimum_power = self.__loads.get_minimum_power(self.__active_loads)
-        if minimum_power + self.__hysteresis_to_grid <= -self.__power.get_power().get():
+        # Power and temperature are pushed to us, only the weather is queried and within a time budget
+        start = time.monotonic()
+        power = self.__get_power()
+        minimum_power = self.__loads.get_minimum_power(self.__active)
+        if power is not None and minimum_power + self.__hysteresis_to_grid <= -power:
             if self.check_temperature_min(self.__temperature_solar):
                 self.do_delay(0, "solar")
-        elif self.__schedule_start <= datetime.now(tz=UTC).hour < self.__schedule_stop:
+        elif self.__schedule_start <= self.clock.now().hour < self.__schedule_stop:
             if self.__schedule_trigger or self.get_scheduled_by_weather():
                 if self.check_temperature_min(self.__temperature_schedule):
                     self.do_delay(0, "schedule")
+        elapsed = time.monotonic() - start
+        if elapsed > self.__input_timeout:
+            self.logger.warning("Idle decision took %.1fs", elapsed)
 
     def on_exit_idle(self):
         self.logger.info("Exiting idle state")
@@ -202,14 +380,16 @@ class WattPilot(WattPilotActor):
         assert isinstance(value, bool)
         self.logger.info("Schedule trigger has been %sable", "en" if value else "dis")
         self.__schedule_trigger = value
+        status.update(schedule_trigger=value)
 
     def on_enter_schedule(self):
         self.logger.info("Entering schedule state")
         self.__schedule_trigger = False
+        status.update(schedule_trigger=False)
         self.__start_all_inactive()
 
     def after_schedule(self):
-        if datetime.now(tz=UTC).hour >= self.__schedule_stop:
+        if self.clock.now().hour >= self.__schedule_stop:
             self.do_delay(0, "idle")
         elif self.check_temperature_max(self.__temperature_schedule):
             self.do_delay(0, "idle")
@@ -222,26 +402,47 @@ class WattPilot(WattPilotActor):
 
     def on_enter_solar(self):
         self.logger.info("Entering solar state")
-        self.__power.register_callback(self._proxy.update_power).get()
+        self.__clear_power()
+        self.__power.register_callback(self._proxy.set_power).get()
         self.__power.run.defer(30)
+        self.__arm_power_watchdog()
+
+    def __switch_loads(self, active):
+        now = self.clock.now().timestamp()
+        snapshots = {snapshot.pin: snapshot for snapshot in self.__snapshots}
+        self.__loads.switch(self.__active, active)
+        for load in self.__loads.get_loads(self.__active & ~active):
+            snapshot = snapshots.pop(load.pin)
+            self.__energy[load.pin] = snapshot.energy + snapshot.power * (now - snapshot.since) / 3600
+        for load in self.__loads.get_loads(active & ~self.__active):
+            snapshots[load.pin] = LoadSnapshot(load.pin, load.power, now, self.__energy.get(load.pin, 0.0))
+        self.__active = active
+        self.__snapshots = tuple(snapshots[pin] for pin in self.__loads.get_pins(active))
+        self.__publish_loads()
 
     def after_solar_power(self):
-        power = self.__power.get_power().get()
+        power = self.__get_power()
+        if power is None:
+            self.logger.warning("No recent power reading, stopping the loads")
+            self.do_delay(0, "idle")
+            return
         if self.check_temperature_max(self.__temperature_solar):
             self.do_delay(0, "idle")
-        elif power > self.__hysteresis_from_grid:
-            if not self.__active_loads:
+            return
+        # Go straight to the best set of loads for the power available, instead of one load per sample
+        active_power = self.__loads.get_power(self.__active)
+        if power > self.__hysteresis_from_grid:
+            loads = self.__loads.get_best_loads(active_power - power + self.__hysteresis_from_grid, self.__active)
+            if not loads:
                 self.do_delay(0, "idle")
-            else:
-                self.logger.info("Turning a load off, power consumption at %dW", power)
-                load = self.__active_loads.pop()
-                load.set_pin(False)
+                return
+            self.logger.info("Power consumption at %dW, loads: %s", power, self.__loads.get_pins(loads))
         else:
-            load = self.__loads.get_load(-power - self.__hysteresis_to_grid, self.__active_loads)
-            if load is not None:
-                self.logger.info("Turning a load on, power generation at %dW", -power)
-                self.__active_loads.append(load)
-                load.set_pin(True)
+            loads = self.__loads.get_best_loads(active_power - power - self.__hysteresis_to_grid, self.__active)
+            if self.__loads.get_power(loads) <= active_power:
+                return
+            self.logger.info("Power generation at %dW, loads: %s", -power, self.__loads.get_pins(loads))
+        self.__switch_loads(loads)
 
     def on_exit_solar(self):
         self.logger.info("Exiting solar state")